@@ -0,0 +1,238 @@
+# -*- coding: utf-8 -*-
+import sys
+import argparse
+import gc
+import importlib
+import json
+import multiprocessing
+import random
+import resource
+import time
+
+# editor module: (target factory, command table factory, graph getter)
+VARIANTS = {
+    'graph_editor': (
+        lambda module: module.Document(),
+        lambda module, target: module.get_command_table(target),
+        lambda target: target.graph,
+    ),
+    'graph_editor_with_states': (
+        lambda module: module.Document(),
+        lambda module, target: module.get_command_table(target),
+        lambda target: target.graph,
+    ),
+    'graph_editor_command_pattern': (
+        lambda module: module.Graph('mygraph'),
+        lambda module, target: module.get_command_table(),
+        lambda target: target,
+    ),
+}
+DEFAULT_SCALES = [1000, 10000, 100000]
+# edges per vertex in generated graphs
+EDGE_FACTOR = 2
+COLORS = ['red', 'green', 'blue', 'black', 'white']
+# undo steps taken back (and redone) at most
+UNDO_CHAIN = 10000
+# relative slowdown reported as a regression
+DEFAULT_TOLERANCE = 0.25
+
+
+# command lines of every phase, generated before the phase (and dropped
+# after it) so that neither timing nor memory counts them; the same seed
+# gives the same commands to every variant
+def get_phases(scale, seed):
+    rng = random.Random(seed)
+    names = ['v%d' % i for i in xrange(scale)]
+    edges = set()
+    while len(edges) < scale * EDGE_FACTOR:
+        (i, j) = (rng.randrange(scale), rng.randrange(scale))
+        if i != j:
+            edges.add((min(i, j), max(i, j)))
+    edges = sorted(edges)
+    rng.shuffle(edges)
+    removed_edges = edges[:len(edges) / 4]
+    removed_vertices = rng.sample(names, scale / 4)
+    yield ('add_vertex', [['add_vertex', name] for name in names])
+    yield ('add_edge', [
+        ['add_edge', names[tail], names[head]] for (tail, head) in edges])
+    yield ('set_vertex_attribute', [
+        ['set_vertex_attribute', name, 'color', rng.choice(COLORS)]
+        for name in names])
+    yield ('set_edge_attribute', [
+        ['set_edge_attribute', names[tail], names[head], 'weight',
+         str(rng.randrange(100))] for (tail, head) in edges])
+    yield ('remove_edge', [
+        ['remove_edge', names[tail], names[head]]
+        for (tail, head) in removed_edges])
+    yield ('remove_vertex', [
+        ['remove_vertex', name] for name in removed_vertices])
+
+
+# resident set size in kilobytes, Linux only
+def get_memory():
+    with open('/proc/self/statm') as stream:
+        pages = int(stream.read().split()[1])
+    return pages * resource.getpagesize() / 1024
+
+
+# the kernel keeps the peak resident set size of the process; writing 5 to
+# clear_refs resets it to the current size, so that it covers one phase
+def reset_peak_memory():
+    with open('/proc/self/clear_refs', 'w') as stream:
+        stream.write('5')
+
+
+# peak resident set size in kilobytes since the last reset
+def get_peak_memory():
+    with open('/proc/self/status') as stream:
+        for line in stream:
+            if line.startswith('VmHWM:'):
+                return int(line.split()[1])
+    return None
+
+
+# function returns the number of failed operations
+def measure(results, phase, operations, function, *args):
+    objects = len(gc.get_objects())
+    memory = get_memory()
+    reset_peak_memory()
+    started = time.time()
+    errors = function(*args)
+    seconds = time.time() - started
+    peak_memory = get_peak_memory()
+    memory = get_memory() - memory
+    results.append({
+        'phase': phase,
+        'operations': operations,
+        'errors': errors,
+        'seconds': seconds,
+        'ops_per_second': operations / seconds if seconds else None,
+# growth of objects tracked by the cyclic GC, the closest thing to an
+# allocation count Python 2 has
+        'objects': len(gc.get_objects()) - objects,
+# the most the process held during the phase, temporaries included
+        'peak_memory_kb': peak_memory,
+# what the phase added to the process: the editor's data, plus freed
+# memory the allocator keeps for reuse
+        'memory_kb': memory,
+    })
+
+
+# failed commands are counted, not fatal: a variant that can't undo some
+# edit shows up in the results instead of breaking the run
+def run_commands(module, target, table, commands):
+    errors = 0
+    for words in commands:
+        try:
+            module.run_command(target, module.parse_command(table, words))
+        except (AttributeError, IndexError, ValueError):
+            errors += 1
+    return errors
+
+
+def render_dot(graph):
+    graph.get_dot_graph()
+    return 0
+
+
+# one variant at one scale; runs in a process of its own, so that the
+# memory of earlier cases doesn't count
+def run_case(variant, scale, seed):
+    (make_target, make_table, get_graph) = VARIANTS[variant]
+    module = importlib.import_module(variant)
+    target = make_target(module)
+    table = make_table(module, target)
+    results = []
+    count = 0
+    for (phase, commands) in get_phases(scale, seed):
+        measure(results, phase, len(commands),
+                run_commands, module, target, table, commands)
+        count += len(commands)
+        del commands
+    for phase in ('get_dot_graph', 'get_dot_graph_again'):
+        measure(results, phase, 1, render_dot, get_graph(target))
+    steps = min(count, UNDO_CHAIN)
+    for phase in ('undo', 'redo'):
+        measure(results, phase, steps,
+                run_commands, module, target, table, [[phase]] * steps)
+    for result in results:
+        result.update({'variant': variant, 'scale': scale, 'seed': seed})
+    return results
+
+
+def run_benchmarks(variants, scales, seed):
+    results = []
+    for variant in variants:
+        for scale in scales:
+            pool = multiprocessing.Pool(1)
+            try:
+                case = pool.apply(run_case, (variant, scale, seed))
+            finally:
+                pool.terminate()
+                pool.join()
+            for result in case:
+                sys.stderr.write(
+                    '%-29s %7d %-21s %9.4f s %10d ops/s %8d KB peak'
+                    ' %+8d KB %d errors\n'
+                    % (variant, scale, result['phase'], result['seconds'],
+                       result['ops_per_second'] or 0,
+                       result['peak_memory_kb'], result['memory_kb'],
+                       result['errors']))
+            results.extend(case)
+    return results
+
+
+# phases that got slower than the baseline by more than the tolerance
+def find_regressions(results, baseline, tolerance):
+    def key(result):
+        return (result['variant'], result['scale'], result['phase'])
+    before = dict((key(result), result) for result in baseline)
+    regressions = []
+    for result in results:
+        old = before.get(key(result))
+        if old is None or not old['seconds']:
+            continue
+        if result['seconds'] > old['seconds'] * (1 + tolerance):
+            regressions.append((result, old))
+    return regressions
+
+
+def get_cli_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--variants', default=','.join(sorted(VARIANTS)),
+        help='comma-separated editor modules')
+    parser.add_argument(
+        '--scales', default=','.join(str(s) for s in DEFAULT_SCALES),
+        help='comma-separated vertex counts')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument(
+        '--output', metavar='FILE', help='write results as JSON to FILE')
+    parser.add_argument(
+        '--baseline', metavar='FILE',
+        help='compare with results of an earlier run')
+    parser.add_argument(
+        '--tolerance', type=float, default=DEFAULT_TOLERANCE,
+        help='relative slowdown that counts as a regression')
+    return parser
+
+if __name__ == '__main__':
+    options = get_cli_parser().parse_args()
+    variants = options.variants.split(',')
+    for variant in variants:
+        if variant not in VARIANTS:
+            sys.exit('Unknown variant %s' % variant)
+    scales = [int(scale) for scale in options.scales.split(',')]
+    results = run_benchmarks(variants, scales, options.seed)
+    if options.output:
+        with open(options.output, 'w') as stream:
+            json.dump(results, stream, indent=1, sort_keys=True)
+    if options.baseline:
+        with open(options.baseline) as stream:
+            baseline = json.load(stream)
+        regressions = find_regressions(results, baseline, options.tolerance)
+        for (result, old) in regressions:
+            sys.stderr.write('regression: %s %d %s %.4f s (was %.4f s)\n' % (
+                result['variant'], result['scale'], result['phase'],
+                result['seconds'], old['seconds']))
+        sys.exit(1 if regressions else 0)
@@ -2,21 +2,136 @@
 import sys
 import re
 import argparse
+import array
+import bisect
+import collections
+import gc
+import heapq
+import json
+import mmap
+import multiprocessing
+import os
+import shutil
+import struct
+import threading
+import time
+import zlib
+# analytics commands need NumPy, everything else works without it; it is
+# imported by the first of them (see import_numpy), not at start
+numpy = None
 
+# bytes of DOT text collected before each write to the output stream
+DOT_CHUNK_SIZE = 64 * 1024
+# input lines parsed, validated and inserted together by bulk import
+IMPORT_BATCH_SIZE = 10000
+# bytes of input per parallel import task; smaller files are split into
+# IMPORT_SHARDS_PER_JOB tasks per worker, but not below the minimum
+IMPORT_SHARD_SIZE = 16 * 1024 * 1024
+IMPORT_MIN_SHARD_SIZE = 256 * 1024
+IMPORT_SHARDS_PER_JOB = 4
 
+VERTEX_ID_BITS = 32
+VERTEX_ID_MASK = (1 << VERTEX_ID_BITS) - 1
+
+# an empty name is invalid too
+INVALID_NAME = re.compile('[^a-zA-Z_0-9]|^$')
+# newline separates names, so a whole batch is checked with one scan; an
+# empty line is an empty name
+INVALID_NAMES = re.compile('[^a-zA-Z_0-9\n]|^$', re.M)
+# valid names remembered by the validator, per generation
+VALID_NAMES_CACHE_SIZE = 100000
+
+PAGERANK_DAMPING = 0.85
+PAGERANK_TOLERANCE = 1e-6
+PAGERANK_MAX_ITERATIONS = 100
+
+
+# remembers names that already passed the check; two generations of sets
+# give LRU-like eviction: a hit in the old one moves the name to the new one,
+# and the old one is dropped when the new one fills up
+class NameValidator(object):
+    def __init__(self, size=VALID_NAMES_CACHE_SIZE):
+        self.size = size
+        self.recent = set()
+        self.older = set()
+
+    def remember(self, name):
+        if len(self.recent) >= self.size:
+            self.older = self.recent
+            self.recent = set()
+        self.recent.add(name)
+
+    def validate(self, name):
+        if name in self.recent:
+            return
+        if name not in self.older and INVALID_NAME.search(name):
+            raise AttributeError('You can use only letters, digits and _')
+        self.remember(name)
+
+    def validate_all(self, names):
+        recent = self.recent
+        older = self.older
+        unseen = [name for name in set(names)
+                  if name not in recent and name not in older]
+        if not unseen:
+            return
+        text = '\n'.join(unseen)
+        match = INVALID_NAMES.search(text)
+        if match:
+            name = unseen[text.count('\n', 0, match.start())]
+            raise AttributeError(
+                'You can use only letters, digits and _ (got %s)' % name)
+        for name in unseen:
+            self.remember(name)
+
+name_validator = NameValidator()
+validate_name = name_validator.validate
+validate_names = name_validator.validate_all
+
+
+# options of every item without options; it is never modified, an item gets
+# its own dict on the first set_option
+class EmptyOptions(dict):
+    def __setitem__(self, key, value):
+        raise TypeError('Shared empty options are read-only')
+
+    def update(self, *args, **kwargs):
+        raise TypeError('Shared empty options are read-only')
+
+# unpickles to the shared instance
+    def __reduce__(self):
+        return 'EMPTY_OPTIONS'
+
+EMPTY_OPTIONS = EmptyOptions()
+
+
+# items have no __dict__: most of them only hold a name or two
 class Item(object):
+    __slots__ = ('options',)
+
     def __init__():
         self.options = {}
 
     def set_option(self, key, value):
-        if re.search('[^a-zA-Z_0-9]', key):
-            raise AttributeError('You can use only letters, digits and _')
+        validate_name(key)
+        if self.options is EMPTY_OPTIONS:
+            self.options = {}
         self.options[key] = value
 
     def remove_option(self, key):
         if key not in self.options:
             raise AttributeError('No option with key %s' % key)
         del self.options[key]
+        if not self.options:
+            self.options = EMPTY_OPTIONS
+
+    def update_options(self, options):
+        if self.options is EMPTY_OPTIONS:
+            self.options = {}
+        self.options.update(options)
+
+    def replace_options(self, options):
+        self.options = dict(options) if options else EMPTY_OPTIONS
 
 # generalized function for getting Item options to be printed
     def get_printable_options(self):
@@ -31,38 +146,328 @@ class Item(object):
 
 
 class Vertex(Item):
-    def __init__(self, vertex_name):
-        if re.search('[^a-zA-Z_0-9]', vertex_name):
-            raise AttributeError('You can use only letters, digits and _')
+    __slots__ = ('vertex_name',)
+
+    def __init__(self, vertex_name, validate=True):
+        if validate:
+            validate_name(vertex_name)
         self.vertex_name = vertex_name
-        self.options = {}
+        self.options = EMPTY_OPTIONS
 
 
 class Edge(Item):
-    def __init__(self, name1, name2):
-        if re.search('[^a-zA-Z_0-9]', name1):
-            raise AttributeError('You can use only letters, digits and _')
-        if re.search('[^a-zA-Z_0-9]', name2):
-            raise AttributeError('You can use only letters, digits and _')
+    __slots__ = ('name1', 'name2')
+
+    def __init__(self, name1, name2, validate=True):
+        if validate:
+            validate_name(name1)
+            validate_name(name2)
         self.name1 = name1
         self.name2 = name2
+        self.options = EMPTY_OPTIONS
+
+
+# undo log record types; vertices are referred to by interned id
+ADD_VERTEX = 1
+REMOVE_VERTEX = 2
+ADD_EDGE = 3
+REMOVE_EDGE = 4
+SET_VERTEX_OPTION = 5
+SET_EDGE_OPTION = 6
+INVERSE_OPERATION = {
+    ADD_VERTEX: REMOVE_VERTEX,
+    REMOVE_VERTEX: ADD_VERTEX,
+    ADD_EDGE: REMOVE_EDGE,
+    REMOVE_EDGE: ADD_EDGE,
+}
+DELTA_VERTEX = struct.Struct('<BI')
+DELTA_EDGE = struct.Struct('<BII')
+DELTA_LENGTH = struct.Struct('<I')
+# length of a missing option value
+NO_VALUE = 0xFFFFFFFF
+
+
+# packs what one edit changed: every primitive change in the order it was
+# made, option changes with both the old and the new value
+class DeltaWriter(object):
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def getvalue(self):
+        return str(self.buffer)
+
+    def add_vertex(self, vertex_id):
+        self.buffer.extend(DELTA_VERTEX.pack(ADD_VERTEX, vertex_id))
+
+    def remove_vertex(self, vertex_id):
+        self.buffer.extend(DELTA_VERTEX.pack(REMOVE_VERTEX, vertex_id))
+
+    def add_edge(self, id1, id2):
+        self.buffer.extend(DELTA_EDGE.pack(ADD_EDGE, id1, id2))
+
+    def remove_edge(self, id1, id2):
+        self.buffer.extend(DELTA_EDGE.pack(REMOVE_EDGE, id1, id2))
+
+    def set_vertex_option(self, vertex_id, key, old, new):
+        self.buffer.extend(DELTA_VERTEX.pack(SET_VERTEX_OPTION, vertex_id))
+        self.write_strings(key, old, new)
+
+    def set_edge_option(self, id1, id2, key, old, new):
+        self.buffer.extend(DELTA_EDGE.pack(SET_EDGE_OPTION, id1, id2))
+        self.write_strings(key, old, new)
+
+    def write_strings(self, *strings):
+        for string in strings:
+            if string is None:
+                self.buffer.extend(DELTA_LENGTH.pack(NO_VALUE))
+            else:
+                self.buffer.extend(DELTA_LENGTH.pack(len(string)))
+                self.buffer.extend(string)
+
+
+def read_delta_string(delta, offset):
+    (length,) = DELTA_LENGTH.unpack_from(delta, offset)
+    offset += DELTA_LENGTH.size
+    if length == NO_VALUE:
+        return (None, offset)
+    return (delta[offset:offset + length], offset + length)
+
+
+# list of (operation, ids, key, old, new) records
+def read_delta(delta):
+    records = []
+    offset = 0
+    while offset < len(delta):
+        operation = ord(delta[offset])
+        if operation in (ADD_VERTEX, REMOVE_VERTEX, SET_VERTEX_OPTION):
+            ids = DELTA_VERTEX.unpack_from(delta, offset)[1:]
+            offset += DELTA_VERTEX.size
+        else:
+            ids = DELTA_EDGE.unpack_from(delta, offset)[1:]
+            offset += DELTA_EDGE.size
+        (key, old, new) = (None, None, None)
+        if operation in (SET_VERTEX_OPTION, SET_EDGE_OPTION):
+            (key, offset) = read_delta_string(delta, offset)
+            (old, offset) = read_delta_string(delta, offset)
+            (new, offset) = read_delta_string(delta, offset)
+        records.append((operation, ids, key, old, new))
+    return records
+
+
+# everything one bulk import changed: the added items and option values of
+# items that existed before
+class BulkChange(object):
+    def __init__(self):
+        self.vertices = {}
+        self.edges = {}
         self.options = {}
 
-# hide logics for naming inside class
-    @staticmethod
-    def get_edge_name(name1, name2):
-        (name1, name2) = sorted([name1, name2])
-        return ''.join((name1, ':', name2))
 
-    def has_vertex(self, name):
-        return True if name in [self.name1, self.name2] else False
+# disjoint sets of vertex ids; sets can only be merged, so removing a vertex
+# or an edge makes the graph build them anew on the next query
+class UnionFind(object):
+    def __init__(self, count=0):
+        self.parent = array.array('L', xrange(count))
+        self.size = array.array('L', [1]) * count
+
+    def add(self, item):
+        while len(self.parent) <= item:
+            self.parent.append(len(self.parent))
+            self.size.append(1)
+        self.parent[item] = item
+        self.size[item] = 1
+
+    def find(self, item):
+        parent = self.parent
+        while parent[item] != item:
+            parent[item] = parent[parent[item]]
+            item = parent[item]
+        return item
+
+    def union(self, item1, item2):
+        root1 = self.find(item1)
+        root2 = self.find(item2)
+        if root1 == root2:
+            return
+        if self.size[root1] < self.size[root2]:
+            (root1, root2) = (root2, root1)
+        self.parent[root2] = root1
+        self.size[root1] += self.size[root2]
+
+
+# items (vertex names or edge keys) by the value of one option; distinct
+# values are also kept sorted, so a prefix query is a bisect and a scan
+# over just the matching values
+class OptionIndex(object):
+    def __init__(self):
+        self.items = {}
+        self.values = []
+
+    def add(self, value, item):
+        items = self.items.get(value)
+        if items is None:
+            items = self.items[value] = set()
+            bisect.insort(self.values, value)
+        items.add(item)
+
+    def remove(self, value, item):
+        items = self.items[value]
+        items.discard(item)
+        if not items:
+            del self.items[value]
+            del self.values[bisect.bisect_left(self.values, value)]
+
+    def find(self, value):
+        return self.items.get(value, ())
+
+    def find_prefix(self, prefix):
+        values = self.values
+        i = bisect.bisect_left(values, prefix)
+        while i < len(values) and values[i].startswith(prefix):
+            for item in self.items[values[i]]:
+                yield item
+            i += 1
+
+
+# compressed sparse row adjacency: vertex i is names[i] and its neighbors are
+# indices[indptr[i]:indptr[i + 1]]; every edge is stored in both directions
+class CSRMatrix(object):
+    def __init__(self, names, indptr, indices):
+        self.names = names
+        self.indptr = indptr
+        self.indices = indices
+
+    def get_degrees(self):
+        return numpy.diff(self.indptr)
+
+# count of vertices for every degree from 0 to the maximum one
+    def get_degree_histogram(self):
+        return numpy.bincount(self.get_degrees())
+
+    def get_pagerank(self, damping=PAGERANK_DAMPING,
+                     tolerance=PAGERANK_TOLERANCE,
+                     max_iterations=PAGERANK_MAX_ITERATIONS):
+        count = len(self.names)
+        if not count:
+            return numpy.zeros(0)
+        degrees = self.get_degrees()
+        dangling = degrees == 0
+        rank = numpy.full(count, 1.0 / count)
+        for i in xrange(max_iterations):
+            share = numpy.where(
+                dangling, 0.0, rank / numpy.maximum(degrees, 1))
+            incoming = numpy.bincount(
+                self.indices, weights=numpy.repeat(share, degrees),
+                minlength=count)
+# rank of vertices without edges is spread over all vertices
+            new_rank = (1.0 - damping) / count + damping * (
+                incoming + rank[dangling].sum() / count)
+            delta = numpy.abs(new_rank - rank).sum()
+            rank = new_rank
+            if delta < tolerance:
+                break
+        return rank
+
+# each edge is directed from the endpoint of lower (degree, index) to the
+# other one; a triangle is then found exactly once, as two edges leaving the
+# same vertex whose ends are joined by an edge themselves
+    def count_triangles(self):
+        count = len(self.names)
+        degrees = self.get_degrees()
+        sources = numpy.repeat(numpy.arange(count, dtype=numpy.int64), degrees)
+        targets = self.indices.astype(numpy.int64)
+        order = degrees * count + numpy.arange(count, dtype=numpy.int64)
+        forward = order[sources] < order[targets]
+        sources = sources[forward]
+        targets = targets[forward]
+        edges = len(sources)
+        if not edges:
+            return 0
+# pairs (first, second) of positions of edges leaving the same vertex;
+# sources are sorted, so these edges sit next to each other
+        group_end = numpy.searchsorted(sources, sources, side='right')
+        pair_counts = group_end - numpy.arange(edges) - 1
+        total = pair_counts.sum()
+        if not total:
+            return 0
+        first = numpy.repeat(numpy.arange(edges), pair_counts)
+        starts = numpy.cumsum(pair_counts) - pair_counts
+        second = first + 1 + numpy.arange(total) - numpy.repeat(
+            starts, pair_counts)
+        edge_keys = numpy.sort(sources * count + targets)
+        closed = 0
+        for (u, v) in ((targets[first], targets[second]),
+                       (targets[second], targets[first])):
+            keys = u * count + v
+            found = numpy.searchsorted(edge_keys, keys)
+            found = numpy.minimum(found, edges - 1)
+            closed += int((edge_keys[found] == keys).sum())
+        return closed
+
+
+def import_numpy():
+    global numpy
+    if numpy is None:
+        try:
+            import numpy
+        except ImportError:
+            raise ImportError('Graph analytics need NumPy')
 
 
 class Graph(object):
     def __init__(self, name):
         self.name = name
         self.vertex_list = {}
+# edges are keyed by the canonical pair of interned vertex ids
         self.edge_list = {}
+# vertex names are interned to dense integer ids for good, so an edge key
+# kept in history stays valid after its vertices are removed and re-added
+        self.vertex_ids = {}
+        self.vertex_names = []
+# incidence index: vertex id -> set of neighbor ids
+        self.adjacency_list = {}
+# DeltaWriter the edits are recorded to, if any
+        self.delta = None
+# rendered DOT lines by vertex name and edge key, kept from the first print
+# on; edits only mark their elements dirty, the next print re-renders them
+        self.vertex_lines = None
+        self.edge_lines = None
+        self.dirty_vertices = set()
+        self.dirty_edges = set()
+# a lazy graph renders its lines as it reads the file instead: a cache
+# would keep a line for every element of the file
+        self.cache_lines = True
+# connected components, built by the first query
+        self.components = None
+# CSRMatrix for analytics, built on demand and dropped by structure changes
+        self.csr = None
+# OptionIndex by option key, only for the keys asked for
+        self.vertex_indexes = {}
+        self.edge_indexes = {}
+
+    def intern(self, name):
+        vertex_id = self.vertex_ids.get(name)
+        if vertex_id is None:
+            vertex_id = self.vertex_ids[name] = len(self.vertex_names)
+            self.vertex_names.append(name)
+        return vertex_id
+
+# both ids packed into one int, smaller id in the high half
+    @staticmethod
+    def get_edge_key(id1, id2):
+        if id1 > id2:
+            return (id2 << VERTEX_ID_BITS) | id1
+        return (id1 << VERTEX_ID_BITS) | id2
+
+    @staticmethod
+    def split_edge_key(key):
+        return (key >> VERTEX_ID_BITS, key & VERTEX_ID_MASK)
+
+    def find_edge_key(self, name1, name2):
+        vertex_ids = self.vertex_ids
+        if name1 in vertex_ids and name2 in vertex_ids:
+            return Graph.get_edge_key(vertex_ids[name1], vertex_ids[name2])
+        return None
 
     def has_vertex(self, name):
         return True if name in self.vertex_list else False
@@ -71,25 +476,167 @@ class Graph(object):
         if self.has_vertex(name):
             raise AttributeError('Graph has vertex with name %s' % name)
         self.vertex_list[name] = Vertex(name)
+        vertex_id = self.intern(name)
+        self.adjacency_list[vertex_id] = set()
+        self.mark_vertex(name)
+        self.csr = None
+        if self.components is not None:
+            self.components.add(vertex_id)
+        if self.delta is not None:
+            self.delta.add_vertex(vertex_id)
 
     def remove_vertex(self, name):
         if not self.has_vertex(name):
             raise AttributeError('No vertex in graph with name %s' % name)
-        del self.vertex_list[name]
-        for key in self.edge_list.keys():
-            if self.edge_list[key].has_vertex(name):
-                del self.edge_list[key]
+        vertex = self.vertex_list.pop(name)
+        vertex_id = self.vertex_ids[name]
+        self.mark_vertex(name)
+        self.components = None
+        self.csr = None
+        for neighbor in self.adjacency_list.pop(vertex_id):
+            key = Graph.get_edge_key(vertex_id, neighbor)
+            edge = self.edge_list.pop(key)
+            self.mark_edge(key)
+            if neighbor != vertex_id:
+                self.adjacency_list[neighbor].discard(vertex_id)
+            for (k, v) in edge.options.iteritems():
+                self.index_edge_option(key, k, v, None)
+            if self.delta is not None:
+                self.record_edge_removal(edge)
+        for (k, v) in vertex.options.iteritems():
+            self.index_vertex_option(name, k, v, None)
+        if self.delta is not None:
+            for (k, v) in vertex.options.iteritems():
+                self.delta.set_vertex_option(vertex_id, k, v, None)
+            self.delta.remove_vertex(vertex_id)
+
+    def get_degree(self, name):
+        if not self.has_vertex(name):
+            raise AttributeError('No vertex in graph with name %s' % name)
+        return len(self.adjacency_list[self.vertex_ids[name]])
+
+    def get_neighbors(self, name):
+        if not self.has_vertex(name):
+            raise AttributeError('No vertex in graph with name %s' % name)
+        names = self.vertex_names
+        return [names[i] for i in self.adjacency_list[self.vertex_ids[name]]]
+
+# path as a list of names and its length in edges (or in summed values of
+# the weight option); None if there is no path
+    def get_shortest_path(self, name1, name2, weight=None):
+        for name in (name1, name2):
+            if not self.has_vertex(name):
+                raise AttributeError('No vertex in graph with name %s' % name)
+        source = self.vertex_ids[name1]
+        target = self.vertex_ids[name2]
+        if weight is None:
+            (previous, distance) = self.search_breadth_first(source, target)
+        else:
+            (previous, distance) = self.search_dijkstra(source, target, weight)
+        if target not in previous:
+            return None
+        path = [target]
+        while path[-1] != source:
+            path.append(previous[path[-1]])
+        names = self.vertex_names
+        return ([names[i] for i in reversed(path)], distance)
+
+    def search_breadth_first(self, source, target):
+        adjacency_list = self.adjacency_list
+        previous = {source: source}
+        distance = {source: 0}
+        queue = collections.deque([source])
+        while queue and target not in previous:
+            current = queue.popleft()
+            for neighbor in adjacency_list[current]:
+                if neighbor not in previous:
+                    previous[neighbor] = current
+                    distance[neighbor] = distance[current] + 1
+                    queue.append(neighbor)
+        return (previous, distance.get(target))
+
+    def search_dijkstra(self, source, target, weight):
+        adjacency_list = self.adjacency_list
+        edge_list = self.edge_list
+        previous = {source: source}
+        distance = {source: 0}
+        done = set()
+        heap = [(0, source)]
+        while heap:
+            (current_distance, current) = heapq.heappop(heap)
+            if current in done:
+                continue
+            if current == target:
+                break
+            done.add(current)
+            for neighbor in adjacency_list[current]:
+# a self-loop is never on a shortest path, weighted or not
+                if neighbor == current:
+                    continue
+                edge = edge_list[Graph.get_edge_key(current, neighbor)]
+                length = Graph.get_weight(edge, weight)
+                new_distance = current_distance + length
+                if new_distance < distance.get(neighbor, new_distance + 1):
+                    distance[neighbor] = new_distance
+                    previous[neighbor] = current
+                    heapq.heappush(heap, (new_distance, neighbor))
+        return (previous, distance.get(target))
+
+    @staticmethod
+    def get_weight(edge, key):
+        try:
+            value = float(edge.options[key])
+        except (KeyError, ValueError):
+            raise AttributeError('Edge %s -- %s has no numeric option %s' % (
+                edge.name1, edge.name2, key))
+        if value < 0:
+            raise AttributeError('Edge %s -- %s has negative %s' % (
+                edge.name1, edge.name2, key))
+        return value
+
+    def get_components(self):
+        if self.components is None:
+            components = UnionFind(len(self.vertex_names))
+            for key in self.edge_list:
+                components.union(*Graph.split_edge_key(key))
+            self.components = components
+        groups = {}
+        names = self.vertex_names
+        find = self.components.find
+        for vertex_id in self.adjacency_list:
+            groups.setdefault(find(vertex_id), []).append(names[vertex_id])
+        return groups.values()
+
+    def is_connected(self, name1, name2):
+        for name in (name1, name2):
+            if not self.has_vertex(name):
+                raise AttributeError('No vertex in graph with name %s' % name)
+        if self.components is None:
+            self.get_components()
+        find = self.components.find
+        return find(self.vertex_ids[name1]) == find(self.vertex_ids[name2])
 
     def set_vertex_attribute(self, name, key, value):
         vertex = self.get_vertex(name)
+        old = vertex.options.get(key)
         vertex.set_option(key, value)
+        self.mark_vertex(name)
+        self.index_vertex_option(name, key, old, value)
+        if self.delta is not None:
+            self.delta.set_vertex_option(
+                self.vertex_ids[name], key, old, value)
 
     def remove_vertex_attribute(self, name, key):
         vertex = self.get_vertex(name)
+        old = vertex.options.get(key)
         vertex.remove_option(key)
+        self.mark_vertex(name)
+        self.index_vertex_option(name, key, old, None)
+        if self.delta is not None:
+            self.delta.set_vertex_option(self.vertex_ids[name], key, old, None)
 
     def has_edge(self, name1, name2):
-        if Edge.get_edge_name(name1, name2) in self.edge_list:
+        if self.find_edge_key(name1, name2) in self.edge_list:
             return True
         return False
 
@@ -98,14 +645,158 @@ class Graph(object):
             raise AttributeError('No vertex with name %s' % name1)
         if not self.has_vertex(name2):
             raise AttributeError('No vertex with name %s' % name2)
-        if self.has_edge(name1, name2):
+        id1 = self.vertex_ids[name1]
+        id2 = self.vertex_ids[name2]
+        key = Graph.get_edge_key(id1, id2)
+        if key in self.edge_list:
             raise AttributeError('Graph has edge %s -- %s' % (name1, name2))
-        self.edge_list[Edge.get_edge_name(name1, name2)] = Edge(name1, name2)
+        self.edge_list[key] = Edge(
+            self.vertex_names[id1], self.vertex_names[id2])
+        self.adjacency_list[id1].add(id2)
+        self.adjacency_list[id2].add(id1)
+        self.mark_edge(key)
+        self.csr = None
+        if self.components is not None:
+            self.components.union(id1, id2)
+        if self.delta is not None:
+            self.delta.add_edge(id1, id2)
 
     def remove_edge(self, name1, name2):
-        if not self.has_edge(name1, name2):
+        key = self.find_edge_key(name1, name2)
+        if key not in self.edge_list:
             raise AttributeError('No edge between %s and %s' % (name1, name2))
-        del self.edge_list[Edge.get_edge_name(name1, name2)]
+        edge = self.edge_list.pop(key)
+        (id1, id2) = Graph.split_edge_key(key)
+        self.adjacency_list[id1].discard(id2)
+        self.adjacency_list[id2].discard(id1)
+        self.mark_edge(key)
+        self.components = None
+        self.csr = None
+        for (k, v) in edge.options.iteritems():
+            self.index_edge_option(key, k, v, None)
+        if self.delta is not None:
+            self.record_edge_removal(edge)
+
+# options go first, so that undo adds the edge back before its options
+    def record_edge_removal(self, edge):
+        id1 = self.vertex_ids[edge.name1]
+        id2 = self.vertex_ids[edge.name2]
+        for (k, v) in edge.options.iteritems():
+            self.delta.set_edge_option(id1, id2, k, v, None)
+        self.delta.remove_edge(id1, id2)
+
+    def mark_vertex(self, name):
+        if self.vertex_lines is not None:
+            self.dirty_vertices.add(name)
+
+    def mark_edge(self, key):
+        if self.edge_lines is not None:
+            self.dirty_edges.add(key)
+
+# everything a bulk import added or changed, for the DOT line cache
+    def mark_change(self, change):
+        if self.vertex_lines is None:
+            return
+        self.dirty_vertices.update(change.vertices)
+        self.dirty_edges.update(change.edges)
+        for entry in change.options.itervalues():
+            item = entry[0]
+            if isinstance(item, Vertex):
+                self.dirty_vertices.add(item.vertex_name)
+            else:
+                self.dirty_edges.add(
+                    self.find_edge_key(item.name1, item.name2))
+
+    def index_vertex_option(self, name, key, old, new):
+        index = self.vertex_indexes.get(key)
+        if index is None:
+            return
+        if old is not None:
+            index.remove(old, name)
+        if new is not None:
+            index.add(new, name)
+
+    def index_edge_option(self, edge_key, key, old, new):
+        index = self.edge_indexes.get(key)
+        if index is None:
+            return
+        if old is not None:
+            index.remove(old, edge_key)
+        if new is not None:
+            index.add(new, edge_key)
+
+# option values a successful bulk import added or changed
+    def index_change(self, change):
+        if not self.vertex_indexes and not self.edge_indexes:
+            return
+        for (name, vertex) in change.vertices.iteritems():
+            for (k, v) in vertex.options.iteritems():
+                self.index_vertex_option(name, k, None, v)
+        for (edge_key, edge) in change.edges.iteritems():
+            for (k, v) in edge.options.iteritems():
+                self.index_edge_option(edge_key, k, None, v)
+        for (item, before, after) in change.options.itervalues():
+            if isinstance(item, Vertex):
+                for k in after:
+                    self.index_vertex_option(
+                        item.vertex_name, k, before.get(k), after[k])
+            else:
+                edge_key = self.find_edge_key(item.name1, item.name2)
+                for k in after:
+                    self.index_edge_option(
+                        edge_key, k, before.get(k), after[k])
+
+    def add_vertex_index(self, key):
+        validate_name(key)
+        index = self.vertex_indexes[key] = OptionIndex()
+        for (name, vertex) in self.vertex_list.iteritems():
+            if key in vertex.options:
+                index.add(vertex.options[key], name)
+
+    def add_edge_index(self, key):
+        validate_name(key)
+        index = self.edge_indexes[key] = OptionIndex()
+        for (edge_key, edge) in self.edge_list.iteritems():
+            if key in edge.options:
+                index.add(edge.options[key], edge_key)
+
+    def remove_vertex_index(self, key):
+        if self.vertex_indexes.pop(key, None) is None:
+            raise AttributeError('No vertex index on %s' % key)
+
+    def remove_edge_index(self, key):
+        if self.edge_indexes.pop(key, None) is None:
+            raise AttributeError('No edge index on %s' % key)
+
+# keys without an index are answered by a scan over all vertices or edges
+    def find_vertices(self, key, value, prefix=False):
+        index = self.vertex_indexes.get(key)
+        if index is not None:
+            if prefix:
+                return list(index.find_prefix(value))
+            return list(index.find(value))
+        return [name for (name, vertex) in self.vertex_list.iteritems()
+                if Graph.option_matches(vertex, key, value, prefix)]
+
+    def find_edges(self, key, value, prefix=False):
+        index = self.edge_indexes.get(key)
+        if index is not None:
+            if prefix:
+                keys = index.find_prefix(value)
+            else:
+                keys = index.find(value)
+            edges = [self.edge_list[k] for k in keys]
+        else:
+            edges = [edge for edge in self.edge_list.itervalues()
+                     if Graph.option_matches(edge, key, value, prefix)]
+        return [(edge.name1, edge.name2) for edge in edges]
+
+    @staticmethod
+    def option_matches(item, key, value, prefix):
+        option = item.options.get(key)
+        if option is None:
+            return False
+        return option.startswith(value) if prefix else option == value
 
     def get_vertex(self, name):
         if not self.has_vertex(name):
@@ -113,71 +804,1522 @@ class Graph(object):
         return self.vertex_list[name]
 
     def get_edge(self, name1, name2):
-        if not self.has_edge(name1, name2):
+        edge = self.edge_list.get(self.find_edge_key(name1, name2))
+        if edge is None:
             raise AttributeError('No edge between %s and %s' % (name1, name2))
-        return self.edge_list[Edge.get_edge_name(name1, name2)]
+        return edge
 
     def set_edge_attribute(self, name1, name2, key, value):
         edge = self.get_edge(name1, name2)
+        old = edge.options.get(key)
         edge.set_option(key, value)
+        edge_key = self.find_edge_key(name1, name2)
+        self.mark_edge(edge_key)
+        self.index_edge_option(edge_key, key, old, value)
+        if self.delta is not None:
+            self.delta.set_edge_option(
+                self.vertex_ids[name1], self.vertex_ids[name2],
+                key, old, value)
 
     def remove_edge_attribute(self, name1, name2, key):
         edge = self.get_edge(name1, name2)
+        old = edge.options.get(key)
         edge.remove_option(key)
+        edge_key = self.find_edge_key(name1, name2)
+        self.mark_edge(edge_key)
+        self.index_edge_option(edge_key, key, old, None)
+        if self.delta is not None:
+            self.delta.set_edge_option(
+                self.vertex_ids[name1], self.vertex_ids[name2], key, old, None)
 
-    def get_dot_graph(self):
-        buffer = ['graph ', self.name, ' {\n']
-        for k, v in self.vertex_list.iteritems():
-            options = v.get_printable_options()
-            buffer.extend([k, options, ';\n'])
-        for k, v in self.edge_list.iteritems():
-            options = v.get_printable_options()
-            buffer.extend([v.name1, ' -- ', v.name2, options, ';\n'])
-        buffer.append('}\n')
-        return ''.join(buffer)
+# batches already validated (and deduplicated) by import workers skip the
+# name checks
+    def bulk_import(self, batches, validate=True):
+        change = BulkChange()
+# lots of long-living objects and no garbage: skip the cyclic GC passes
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            for (vertices, edges) in batches:
+                self.import_batch(change, vertices, edges, validate)
+        except Exception:
+            self.revert_change(change)
+            raise
+        finally:
+            if gc_enabled:
+                gc.enable()
+# remember (before, after) options of items that existed before
+        for (item, before) in change.options.values():
+            change.options[id(item)] = (item, before, dict(item.options))
+        self.mark_change(change)
+        self.index_change(change)
+        if self.delta is not None:
+            self.record_change(change)
+        if change.vertices or change.edges:
+            self.csr = None
+        if self.components is not None:
+            for name in change.vertices:
+                self.components.add(self.vertex_ids[name])
+            for key in change.edges:
+                self.components.union(*Graph.split_edge_key(key))
+        return change
 
+# vertices are (name, options) and edges (name1, name2, options) pairs
+    def import_batch(self, change, vertices, edges, validate=True):
+        if validate:
+            names = [name for (name, options) in vertices]
+            for (name1, name2, options) in edges:
+                names.append(name1)
+                names.append(name2)
+            validate_names(names)
+            validate_names([key for (name, options) in vertices
+                            for key in options])
+            validate_names([key for (name1, name2, options) in edges
+                            for key in options])
+        vertex_list = self.vertex_list
+        vertex_ids = self.vertex_ids
+        vertex_names = self.vertex_names
+        edge_list = self.edge_list
+        adjacency_list = self.adjacency_list
+        for (name, options) in vertices:
+            vertex = vertex_list.get(name)
+            if vertex is None:
+                vertex = vertex_list[name] = Vertex(name, False)
+                adjacency_list[self.intern(name)] = set()
+                change.vertices[name] = vertex
+            if options:
+                self.import_options(
+                    change, vertex, options, name in change.vertices)
+        for (name1, name2, options) in edges:
+            for name in (name1, name2):
+                if name not in vertex_list:
+                    vertex = vertex_list[name] = Vertex(name, False)
+                    adjacency_list[self.intern(name)] = set()
+                    change.vertices[name] = vertex
+            id1 = vertex_ids[name1]
+            id2 = vertex_ids[name2]
+            key = Graph.get_edge_key(id1, id2)
+            edge = edge_list.get(key)
+            if edge is None:
+                edge = edge_list[key] = Edge(
+                    vertex_names[id1], vertex_names[id2], False)
+                adjacency_list[id1].add(id2)
+                adjacency_list[id2].add(id1)
+                change.edges[key] = edge
+            if options:
+                self.import_options(
+                    change, edge, options, key in change.edges)
 
-class Activity(object):
-    def __init__(self, do, undo, params):
-        self.do = do
-        self.undo = undo
-        self.params = params
+    def import_options(self, change, item, options, added):
+        if not added and id(item) not in change.options:
+            change.options[id(item)] = (item, dict(item.options))
+        item.update_options(options)
 
+    def revert_change(self, change):
+        for key in change.edges:
+            del self.edge_list[key]
+            (id1, id2) = Graph.split_edge_key(key)
+            self.adjacency_list[id1].discard(id2)
+            self.adjacency_list[id2].discard(id1)
+        for name in change.vertices:
+            del self.vertex_list[name]
+            del self.adjacency_list[self.vertex_ids[name]]
+        for entry in change.options.itervalues():
+            entry[0].replace_options(entry[1])
+        self.mark_change(change)
+        self.components = None
+        self.csr = None
 
-class History(object):
+    def record_change(self, change):
+        vertex_ids = self.vertex_ids
+        for (name, vertex) in change.vertices.iteritems():
+            self.delta.add_vertex(vertex_ids[name])
+        for edge in change.edges.itervalues():
+            self.delta.add_edge(vertex_ids[edge.name1], vertex_ids[edge.name2])
+        for (name, vertex) in change.vertices.iteritems():
+            for (k, v) in vertex.options.iteritems():
+                self.delta.set_vertex_option(vertex_ids[name], k, None, v)
+        for edge in change.edges.itervalues():
+            for (k, v) in edge.options.iteritems():
+                self.delta.set_edge_option(
+                    vertex_ids[edge.name1], vertex_ids[edge.name2], k, None, v)
+        for (item, before, after) in change.options.itervalues():
+            for k in set(before) | set(after):
+                if before.get(k) == after.get(k):
+                    continue
+                if isinstance(item, Vertex):
+                    self.delta.set_vertex_option(
+                        vertex_ids[item.vertex_name], k,
+                        before.get(k), after.get(k))
+                else:
+                    self.delta.set_edge_option(
+                        vertex_ids[item.name1], vertex_ids[item.name2], k,
+                        before.get(k), after.get(k))
+
+# redo applies the records in order; undo applies their inverses backwards
+# names resolve the vertex ids of the delta, by default the graph's own
+    def replay_delta(self, delta, forward=True, names=None):
+        if names is None:
+            names = self.vertex_names
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            records = read_delta(delta)
+            if not forward:
+                records.reverse()
+            for (operation, ids, key, old, new) in records:
+                if not forward:
+                    operation = INVERSE_OPERATION.get(operation, operation)
+                    (old, new) = (new, old)
+                self.replay_record(operation, ids, key, new, names)
+        finally:
+            if gc_enabled:
+                gc.enable()
+
+    def replay_record(self, operation, ids, key, value, names):
+        if operation == ADD_VERTEX:
+            self.add_vertex(names[ids[0]])
+        elif operation == REMOVE_VERTEX:
+            self.remove_vertex(names[ids[0]])
+        elif operation == ADD_EDGE:
+            self.add_edge(names[ids[0]], names[ids[1]])
+        elif operation == REMOVE_EDGE:
+            self.remove_edge(names[ids[0]], names[ids[1]])
+        elif operation == SET_VERTEX_OPTION:
+            if value is None:
+                self.remove_vertex_attribute(names[ids[0]], key)
+            else:
+                self.set_vertex_attribute(names[ids[0]], key, value)
+        elif value is None:
+            self.remove_edge_attribute(names[ids[0]], names[ids[1]], key)
+        else:
+            self.set_edge_attribute(names[ids[0]], names[ids[1]], key, value)
+
+    def get_csr(self):
+        import_numpy()
+        if self.csr is None:
+            self.csr = self.build_csr()
+        return self.csr
+
+# vertices get indices in adjacency_list order, edges become index pairs in
+# both directions, sorted by their first index
+    def build_csr(self):
+        vertex_ids = numpy.fromiter(
+            self.adjacency_list.iterkeys(), numpy.int64,
+            len(self.adjacency_list))
+        count = len(vertex_ids)
+        index = numpy.full(len(self.vertex_names), -1, numpy.int64)
+        index[vertex_ids] = numpy.arange(count, dtype=numpy.int64)
+        keys = numpy.fromiter(
+            self.edge_list.iterkeys(), numpy.uint64, len(self.edge_list))
+        ends1 = index[(keys >> numpy.uint64(VERTEX_ID_BITS)).astype(
+            numpy.int64)]
+        ends2 = index[(keys & numpy.uint64(VERTEX_ID_MASK)).astype(
+            numpy.int64)]
+# a loop is a single entry in the adjacency of its vertex
+        other = ends1 != ends2
+        rows = numpy.concatenate((ends1, ends2[other]))
+        columns = numpy.concatenate((ends2, ends1[other]))
+        order = numpy.lexsort((columns, rows))
+        indptr = numpy.zeros(count + 1, numpy.int64)
+        numpy.cumsum(numpy.bincount(rows, minlength=count), out=indptr[1:])
+        names = [self.vertex_names[i] for i in vertex_ids]
+        return CSRMatrix(names, indptr, columns[order])
+
+    def get_dot_graph(self, sort=False):
+        return ''.join(self.iter_dot_lines(sort))
+
+    @staticmethod
+    def get_vertex_line(vertex):
+        return ''.join((
+            vertex.vertex_name, vertex.get_printable_options(), ';\n'))
+
+    @staticmethod
+    def get_edge_line(edge):
+        options = edge.get_printable_options()
+        return ''.join((edge.name1, ' -- ', edge.name2, options, ';\n'))
+
+# renders everything on the first call, afterwards only the dirty elements
+    def update_dot_lines(self):
+        if self.vertex_lines is None:
+            self.vertex_lines = dict(
+                (name, Graph.get_vertex_line(vertex))
+                for (name, vertex) in self.vertex_list.iteritems())
+            self.edge_lines = dict(
+                (key, Graph.get_edge_line(edge))
+                for (key, edge) in self.edge_list.iteritems())
+            return
+        for name in self.dirty_vertices:
+            vertex = self.vertex_list.get(name)
+            if vertex is None:
+                self.vertex_lines.pop(name, None)
+            else:
+                self.vertex_lines[name] = Graph.get_vertex_line(vertex)
+        for key in self.dirty_edges:
+            edge = self.edge_list.get(key)
+            if edge is None:
+                self.edge_lines.pop(key, None)
+            else:
+                self.edge_lines[key] = Graph.get_edge_line(edge)
+        self.dirty_vertices.clear()
+        self.dirty_edges.clear()
+
+# sorted order only keeps the list of keys, lines come from the cache
+    def iter_dot_lines(self, sort=False):
+        if self.cache_lines:
+            self.update_dot_lines()
+            vertex_lines = self.vertex_lines
+            edge_lines = self.edge_lines
+        else:
+            vertex_lines = RenderedLines(
+                self.vertex_list, Graph.get_vertex_line)
+            edge_lines = RenderedLines(self.edge_list, Graph.get_edge_line)
+        yield ''.join(('graph ', self.name, ' {\n'))
+        if sort:
+            for name in sorted(vertex_lines):
+                yield vertex_lines[name]
+            names = self.vertex_names
+            keys = sorted(edge_lines, key=lambda k: sorted(
+                names[i] for i in Graph.split_edge_key(k)))
+            for key in keys:
+                yield edge_lines[key]
+        else:
+            for line in vertex_lines.itervalues():
+                yield line
+            for line in edge_lines.itervalues():
+                yield line
+        yield '}\n'
+
+    def write_dot(self, stream, sort=False, chunk_size=DOT_CHUNK_SIZE):
+        buffer = []
+        buffered = 0
+        for line in self.iter_dot_lines(sort):
+            buffer.append(line)
+            buffered += len(line)
+            if buffered >= chunk_size:
+                stream.write(''.join(buffer))
+                del buffer[:]
+                buffered = 0
+        stream.write(''.join(buffer))
+
+
+def parse_options(text):
+    options = {}
+    for pair in text.split():
+        (key, sep, value) = pair.partition('=')
+        if not sep:
+            raise ValueError('Bad option %s' % pair)
+        options[key] = value
+    return options
+
+
+# the dialect get_dot_graph writes: one statement per line, a -- b edges
+def parse_dot_line(line, vertices, edges):
+    line = line.strip()
+    if not line or line == '}' or line.startswith(('graph ', '#', '//')):
+        return
+    if line.endswith(';'):
+        line = line[:-1].rstrip()
+    options = {}
+    if line.endswith(']'):
+        (line, sep, text) = line[:-1].partition('[')
+        if not sep:
+            raise ValueError('Unbalanced [ in statement')
+        options = parse_options(text)
+    names = [name.strip() for name in line.split('--')]
+    if not all(names):
+        raise ValueError('Empty name in statement')
+    if len(names) == 1:
+        vertices.append((names[0], options))
+    for (name1, name2) in zip(names, names[1:]):
+        edges.append((name1, name2, options))
+
+
+# plain edge list: "name1 name2 [key=value ...]", or a single vertex name
+def parse_edge_line(line, vertices, edges):
+    words = line.split()
+    if not words or words[0].startswith('#'):
+        return
+    if len(words) == 1:
+        vertices.append((words[0], {}))
+    else:
+        edges.append((words[0], words[1], parse_options(' '.join(words[2:]))))
+
+
+def read_graph_file(path, file_format):
+    parse_line = parse_dot_line if file_format == 'dot' else parse_edge_line
+    with open(path) as stream:
+        vertices = []
+        edges = []
+        for (line_no, line) in enumerate(stream, 1):
+            try:
+                parse_line(line, vertices, edges)
+            except ValueError, e:
+                raise ValueError('%s:%d: %s' % (path, line_no, e))
+            if line_no % IMPORT_BATCH_SIZE == 0:
+                yield (vertices, edges)
+                vertices = []
+                edges = []
+        yield (vertices, edges)
+
+
+# byte range of an input file handled by one import worker: every line that
+# starts inside it
+def read_graph_shard(task):
+    (path, file_format, start, end) = task
+    parse_line = parse_dot_line if file_format == 'dot' else parse_edge_line
+    vertices = []
+    edges = []
+    with open(path) as stream:
+        if start:
+            stream.seek(start - 1)
+            stream.readline()
+        offset = stream.tell()
+        while offset < end:
+            line = stream.readline()
+            if not line:
+                break
+            try:
+                parse_line(line, vertices, edges)
+            except ValueError, e:
+                raise ValueError('%s: line at byte %d: %s' % (path, offset, e))
+            offset += len(line)
+    return pack_batch(*dedupe_batch(vertices, edges))
+
+
+# validated items with every vertex and every edge (either way round) once;
+# options of repeated items are merged in input order
+def dedupe_batch(vertices, edges):
+    names = [name for (name, options) in vertices]
+    for (name1, name2, options) in edges:
+        names.append(name1)
+        names.append(name2)
+    validate_names(names)
+    validate_names([key for (name, options) in vertices for key in options])
+    validate_names([key for (name1, name2, options) in edges
+                    for key in options])
+    unique_vertices = collections.OrderedDict()
+    for (name, options) in vertices:
+        if name in unique_vertices:
+            options = dict(unique_vertices[name], **options)
+        unique_vertices[name] = options
+    unique_edges = collections.OrderedDict()
+    for (name1, name2, options) in edges:
+        key = (name1, name2) if name1 <= name2 else (name2, name1)
+        edge = unique_edges.get(key)
+        if edge is not None:
+            (name1, name2) = edge[:2]
+            options = dict(edge[2], **options)
+        unique_edges[key] = (name1, name2, options)
+    return (unique_vertices.items(), unique_edges.values())
+
+
+# batches cross process boundaries as newline-joined name columns and only
+# the non-empty options by position, which unpickle much faster than a tuple
+# per item
+def pack_batch(vertices, edges):
+    return (
+        '\n'.join(name for (name, options) in vertices),
+        dict((i, item[-1]) for (i, item) in enumerate(vertices) if item[-1]),
+        '\n'.join(name1 for (name1, name2, options) in edges),
+        '\n'.join(name2 for (name1, name2, options) in edges),
+        dict((i, item[-1]) for (i, item) in enumerate(edges) if item[-1]),
+    )
+
+
+def unpack_batch(batch):
+    (vertex_names, vertex_options, names1, names2, edge_options) = batch
+    vertex_names = vertex_names.split('\n') if vertex_names else []
+    options = [EMPTY_OPTIONS] * len(vertex_names)
+    for (i, item_options) in vertex_options.iteritems():
+        options[i] = item_options
+    vertices = zip(vertex_names, options)
+    names1 = names1.split('\n') if names1 else []
+    options = [EMPTY_OPTIONS] * len(names1)
+    for (i, item_options) in edge_options.iteritems():
+        options[i] = item_options
+    edges = zip(names1, names2.split('\n') if names2 else [], options)
+    return (vertices, edges)
+
+
+def get_shard_tasks(path, file_format, jobs):
+    size = os.path.getsize(path)
+    shard_size = max(
+        IMPORT_MIN_SHARD_SIZE,
+        min(IMPORT_SHARD_SIZE, size // (jobs * IMPORT_SHARDS_PER_JOB) + 1))
+    return [(path, file_format, start, min(start + shard_size, size))
+            for start in xrange(0, size, shard_size)]
+
+
+# workers parse, validate and dedupe shards of the file; batches come back
+# in file order while the next shards are still being read
+def read_graph_file_parallel(path, file_format, jobs):
+    pool = multiprocessing.Pool(jobs)
+    try:
+        for batch in pool.imap(
+                read_graph_shard, get_shard_tasks(path, file_format, jobs)):
+            yield unpack_batch(batch)
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def get_file_format(path):
+    return 'dot' if path.endswith(('.dot', '.gv')) else 'edges'
+
+
+# binary graph file: header, string table (offsets + blob), vertex name ids,
+# fixed-width edge records (two vertex indices) and option records
+# (kind, item index, key id, value id) sorted by kind and item; all numbers
+# are little-endian
+GRAPH_FILE_MAGIC = 'GRPH'
+GRAPH_FILE_VERSION = 1
+GRAPH_FILE_HEADER = struct.Struct('<4sHHIIIII')
+VERTEX_OPTION = 0
+EDGE_OPTION = 1
+# header flag of files followed by lookup sections: vertex indices sorted by
+# name, then adjacency rows (offsets, neighbor indices sorted within a row
+# and the matching edge indices), so that single elements can be found
+# without loading the graph
+GRAPH_FILE_INDEXED = 1
+
+
+def write_graph_file(graph, path):
+    strings = {}
+    blob = []
+    string_offsets = array.array('I', [0])
+
+    def intern(string):
+        string_id = strings.get(string)
+        if string_id is None:
+            string_id = strings[string] = len(blob)
+            blob.append(string)
+            if string_offsets[-1] + len(string) > 0xFFFFFFFF:
+                raise ValueError('String table does not fit in 4 GB')
+            string_offsets.append(string_offsets[-1] + len(string))
+        return string_id
+
+    name_id = intern(graph.name)
+    vertex_ids = {}
+    vertex_names = array.array('I')
+    options = array.array('I')
+    for (index, (name, vertex)) in enumerate(graph.vertex_list.iteritems()):
+        vertex_ids[name] = index
+        vertex_names.append(intern(name))
+        for (k, v) in vertex.options.iteritems():
+            options.extend((VERTEX_OPTION, index, intern(k), intern(v)))
+    edges = array.array('I')
+    for (index, edge) in enumerate(graph.edge_list.itervalues()):
+        edges.append(vertex_ids[edge.name1])
+        edges.append(vertex_ids[edge.name2])
+        for (k, v) in edge.options.iteritems():
+            options.extend((EDGE_OPTION, index, intern(k), intern(v)))
+    names = [blob[i] for i in vertex_names]
+    sorted_vertices = array.array(
+        'I', sorted(xrange(len(names)), key=names.__getitem__))
+    del names
+    (adjacency_offsets, adjacency, adjacency_edges) = get_adjacency(
+        len(vertex_names), edges)
+    sections = (string_offsets, vertex_names, edges, options,
+                sorted_vertices, adjacency_offsets, adjacency, adjacency_edges)
+    if sys.byteorder != 'little':
+        for data in sections:
+            data.byteswap()
+# a new file replaces the old one only when complete; a lazy graph still
+# reading the old one keeps it
+    temporary_path = path + '.tmp'
+    with open(temporary_path, 'wb') as stream:
+        stream.write(GRAPH_FILE_HEADER.pack(
+            GRAPH_FILE_MAGIC, GRAPH_FILE_VERSION, GRAPH_FILE_INDEXED,
+            name_id, len(blob), len(vertex_names), len(edges) / 2,
+            len(options) / 4))
+        string_offsets.tofile(stream)
+        blob_text = ''.join(blob)
+        stream.write(blob_text)
+# keep the number sections 4-byte aligned
+        stream.write('\0' * (-len(blob_text) % 4))
+        for data in sections[1:]:
+            data.tofile(stream)
+    os.rename(temporary_path, path)
+
+
+# adjacency rows of the edges given as pairs of vertex indices, built by
+# counting sort; a loop is a single entry in the row of its vertex
+def get_adjacency(vertex_count, edges):
+    offsets = array.array('I', [0]) * (vertex_count + 1)
+    for (index, vertex) in enumerate(edges):
+        if index % 2 == 0 or vertex != edges[index - 1]:
+            offsets[vertex + 1] += 1
+    total = 0
+    for vertex in xrange(vertex_count + 1):
+        if total + offsets[vertex] > 0xFFFFFFFF:
+            raise ValueError('Adjacency does not fit in 4 GB')
+        total += offsets[vertex]
+        offsets[vertex] = total
+    adjacency = array.array('I', [0]) * total
+    adjacency_edges = array.array('I', [0]) * total
+    ends = array.array('I', offsets[:-1])
+    for index in xrange(len(edges) / 2):
+        (vertex1, vertex2) = (edges[2 * index], edges[2 * index + 1])
+        for (vertex, neighbor) in ((vertex1, vertex2), (vertex2, vertex1)):
+            adjacency[ends[vertex]] = neighbor
+            adjacency_edges[ends[vertex]] = index
+            ends[vertex] += 1
+            if vertex1 == vertex2:
+                break
+    for vertex in xrange(vertex_count):
+        (start, end) = (offsets[vertex], offsets[vertex + 1])
+        if end - start > 1:
+            row = sorted(zip(adjacency[start:end], adjacency_edges[start:end]))
+            (neighbors, indices) = zip(*row)
+            adjacency[start:end] = array.array('I', neighbors)
+            adjacency_edges[start:end] = array.array('I', indices)
+    return (offsets, adjacency, adjacency_edges)
+
+
+# read-only view of a graph file through mmap: nothing is decoded until it is
+# asked for, so big files can be inspected without loading them
+class GraphFile(object):
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as stream:
+            self.data = mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.data.size() < GRAPH_FILE_HEADER.size:
+            raise ValueError('%s is not a graph file' % path)
+        (magic, version, self.flags, self.name_id, self.string_count,
+         self.vertex_count, self.edge_count,
+         self.option_count) = GRAPH_FILE_HEADER.unpack_from(self.data)
+        if magic != GRAPH_FILE_MAGIC or version != GRAPH_FILE_VERSION:
+            raise ValueError('%s is not a graph file' % path)
+        self.string_offsets = GRAPH_FILE_HEADER.size
+        self.blob = self.string_offsets + 4 * (self.string_count + 1)
+        blob_size = self.get_uint('I', self.string_offsets, self.string_count)
+        self.vertex_names = self.blob + blob_size + (-blob_size % 4)
+        self.edges = self.vertex_names + 4 * self.vertex_count
+        self.options = self.edges + 8 * self.edge_count
+        end = self.options + 16 * self.option_count
+        if self.flags & GRAPH_FILE_INDEXED:
+            self.sorted_vertices = end
+            self.adjacency_offsets = end + 4 * self.vertex_count
+            self.adjacency = self.adjacency_offsets + 4 * (
+                self.vertex_count + 1)
+            if self.adjacency > self.data.size():
+                raise ValueError('%s is truncated' % path)
+            count = self.get_uint(
+                'I', self.adjacency_offsets, self.vertex_count)
+            self.adjacency_edges = self.adjacency + 4 * count
+            end = self.adjacency_edges + 4 * count
+        if end != self.data.size():
+            raise ValueError('%s is truncated' % path)
+        self.name = self.get_string(self.name_id)
+
+    def close(self):
+        self.data.close()
+
+    def get_uint(self, typecode, section, index):
+        fmt = '<' + typecode
+        return struct.unpack_from(
+            fmt, self.data, section + struct.calcsize(fmt) * index)[0]
+
+    def get_uint_array(self, typecode, section, count):
+        data = array.array(typecode)
+        data.fromstring(
+            self.data[section:section + data.itemsize * count])
+        if sys.byteorder != 'little':
+            data.byteswap()
+        return data
+
+    def get_string(self, index):
+        (start, end) = struct.unpack_from(
+            '<II', self.data, self.string_offsets + 4 * index)
+        return self.data[self.blob + start:self.blob + end]
+
+    def get_vertex_name(self, index):
+        return self.get_string(self.get_uint('I', self.vertex_names, index))
+
+    def get_edge(self, index):
+        (v1, v2) = struct.unpack_from('<II', self.data, self.edges + 8 * index)
+        return (self.get_vertex_name(v1), self.get_vertex_name(v2))
+
+# lookups below binary search the mmap and need the lookup sections
+    def find_vertex(self, name):
+        (low, high) = (0, self.vertex_count)
+        while low < high:
+            middle = (low + high) / 2
+            index = self.get_uint('I', self.sorted_vertices, middle)
+            found = self.get_vertex_name(index)
+            if found < name:
+                low = middle + 1
+            elif found > name:
+                high = middle
+            else:
+                return index
+        return None
+
+    def get_neighbors(self, index):
+        (start, end) = struct.unpack_from(
+            '<II', self.data, self.adjacency_offsets + 4 * index)
+        return self.get_uint_array(
+            'I', self.adjacency + 4 * start, end - start)
+
+    def find_edge(self, index1, index2):
+        (low, high) = struct.unpack_from(
+            '<II', self.data, self.adjacency_offsets + 4 * index1)
+        while low < high:
+            middle = (low + high) / 2
+            neighbor = self.get_uint('I', self.adjacency, middle)
+            if neighbor < index2:
+                low = middle + 1
+            elif neighbor > index2:
+                high = middle
+            else:
+                return self.get_uint('I', self.adjacency_edges, middle)
+        return None
+
+    def get_options(self, kind, item):
+        (low, high) = (0, self.option_count)
+        while low < high:
+            middle = (low + high) / 2
+            if struct.unpack_from(
+                    '<II', self.data, self.options + 16 * middle) < (
+                    kind, item):
+                low = middle + 1
+            else:
+                high = middle
+        options = {}
+        for index in xrange(low, self.option_count):
+            (found_kind, found_item, k, v) = struct.unpack_from(
+                '<IIII', self.data, self.options + 16 * index)
+            if (found_kind, found_item) != (kind, item):
+                break
+            options[self.get_string(k)] = self.get_string(v)
+        return options
+
+    def iter_options(self):
+        for index in xrange(self.option_count):
+            (kind, item, k, v) = struct.unpack_from(
+                '<IIII', self.data, self.options + 16 * index)
+            yield (kind, item, self.get_string(k), self.get_string(v))
+
+# batches for Graph.bulk_import; options are stored in item order, so they
+# are merged in while walking the vertex and edge sections
+    def iter_batches(self):
+        names = [self.get_vertex_name(index)
+                 for index in xrange(self.vertex_count)]
+        options = collections.defaultdict(dict)
+        for (kind, item, k, v) in self.iter_options():
+            options[(kind, item)][k] = v
+        for start in xrange(0, self.vertex_count, IMPORT_BATCH_SIZE):
+            end = min(start + IMPORT_BATCH_SIZE, self.vertex_count)
+            yield ([(names[index], options.pop((VERTEX_OPTION, index), {}))
+                    for index in xrange(start, end)], [])
+        for start in xrange(0, self.edge_count, IMPORT_BATCH_SIZE):
+            end = min(start + IMPORT_BATCH_SIZE, self.edge_count)
+            edges = self.get_uint_array(
+                'I', self.edges + 8 * start, 2 * (end - start))
+            yield ([], [(names[edges[2 * i]], names[edges[2 * i + 1]],
+                         options.pop((EDGE_OPTION, start + i), {}))
+                        for i in xrange(end - start)])
+
+    def to_graph(self):
+        graph = Graph(self.name)
+        graph.bulk_import(self.iter_batches())
+        return graph
+
+# a graph reading the file as it goes, which has to stay open meanwhile;
+# vertex ids are the indices in the file
+    def to_lazy_graph(self):
+        if not self.flags & GRAPH_FILE_INDEXED:
+            raise ValueError(
+                '%s has no lookup sections, save it again' % self.path)
+        graph = Graph(self.name)
+        graph.vertex_list = LazyVertices(self)
+        graph.edge_list = LazyEdges(self)
+        graph.vertex_ids = LazyVertexIds(self)
+        graph.vertex_names = LazyNames(self)
+        graph.adjacency_list = LazyAdjacency(self)
+        graph.cache_lines = False
+        return graph
+
+
+# vertex names of a graph file followed by the ones interned later
+class LazyNames(object):
+    def __init__(self, graph_file):
+        self.file = graph_file
+        self.base = graph_file.vertex_count
+        self.names = []
+
+    def __len__(self):
+        return self.base + len(self.names)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in xrange(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if 0 <= index < self.base:
+            return self.file.get_vertex_name(index)
+        return self.names[index - self.base]
+
+    def __iter__(self):
+        for index in xrange(len(self)):
+            yield self[index]
+
+    def append(self, name):
+        self.names.append(name)
+
+
+# name -> vertex id; names of the file are looked up in it
+class LazyVertexIds(object):
+    def __init__(self, graph_file):
+        self.file = graph_file
+        self.ids = {}
+
+    def get(self, name, default=None):
+        vertex_id = self.ids.get(name)
+        if vertex_id is None:
+            vertex_id = self.file.find_vertex(name)
+            if vertex_id is None:
+                return default
+            self.ids[name] = vertex_id
+        return vertex_id
+
+    def __contains__(self, name):
+        return self.get(name) is not None
+
+    def __getitem__(self, name):
+        vertex_id = self.get(name)
+        if vertex_id is None:
+            raise KeyError(name)
+        return vertex_id
+
+    def __setitem__(self, name, vertex_id):
+        self.ids[name] = vertex_id
+
+
+# the dict part of the lazy graph containers: elements of the file become
+# objects when first asked for and stay in loaded, like the ones added
+# later; removed holds the keys of file elements that are gone; find gives
+# the file index of a key (or None), load makes the element at an index and
+# iter_file yields (key, index) of every element of the file
+class LazyMapping(object):
+    def __init__(self, graph_file, count, find, load, iter_file):
+        self.file = graph_file
+        self.count = count
+        self.find = find
+        self.load = load
+        self.iter_file = iter_file
+        self.loaded = {}
+        self.removed = set()
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, key):
+        if key in self.loaded:
+            return True
+        return key not in self.removed and self.find(key) is not None
+
+    def get(self, key, default=None):
+        value = self.loaded.get(key)
+        if value is None and key not in self.removed:
+            index = self.find(key)
+            if index is not None:
+                value = self.loaded[key] = self.load(key, index)
+        return default if value is None else value
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+# like get, but a file element read here is not kept
+    def peek(self, key):
+        value = self.loaded.get(key)
+        if value is None and key not in self.removed:
+            index = self.find(key)
+            if index is not None:
+                value = self.load(key, index)
+        return value
+
+    def __setitem__(self, key, value):
+        if key not in self:
+            self.count += 1
+        self.loaded[key] = value
+        self.removed.discard(key)
+
+    def pop(self, key, *default):
+        value = self.get(key)
+        if value is None:
+            if default:
+                return default[0]
+            raise KeyError(key)
+        del self.loaded[key]
+        if self.find(key) is not None:
+            self.removed.add(key)
+        self.count -= 1
+        return value
+
+    def __delitem__(self, key):
+        self.pop(key)
+
+# file elements not asked for yet are read for the iteration only
+    def iteritems(self):
+        loaded = self.loaded
+        removed = self.removed
+        for (key, index) in self.iter_file():
+            if key in removed:
+                continue
+            value = loaded.get(key)
+            if value is None:
+                value = self.load(key, index)
+            yield (key, value)
+        for (key, value) in loaded.iteritems():
+            if self.find(key) is None:
+                yield (key, value)
+
+    def iterkeys(self):
+        for (key, value) in self.iteritems():
+            yield key
+
+    def itervalues(self):
+        for (key, value) in self.iteritems():
+            yield value
+
+    __iter__ = iterkeys
+
+
+class LazyVertices(LazyMapping):
+    def __init__(self, graph_file):
+        LazyMapping.__init__(
+            self, graph_file, graph_file.vertex_count,
+            graph_file.find_vertex, self.load_vertex, self.iter_vertices)
+
+    def load_vertex(self, name, index):
+        vertex = Vertex(name, False)
+        vertex.replace_options(self.file.get_options(VERTEX_OPTION, index))
+        return vertex
+
+    def iter_vertices(self):
+        for index in xrange(self.file.vertex_count):
+            yield (self.file.get_vertex_name(index), index)
+
+
+# keyed by Graph.get_edge_key of the vertex indices in the file
+class LazyEdges(LazyMapping):
+    def __init__(self, graph_file):
+        LazyMapping.__init__(
+            self, graph_file, graph_file.edge_count,
+            self.find_edge, self.load_edge, self.iter_edges)
+
+    def find_edge(self, key):
+# Graph.find_edge_key gives None for names never seen
+        if key is None:
+            return None
+        (id1, id2) = Graph.split_edge_key(key)
+        if id2 >= self.file.vertex_count:
+            return None
+        return self.file.find_edge(id1, id2)
+
+    def load_edge(self, key, index):
+        (name1, name2) = self.file.get_edge(index)
+        edge = Edge(name1, name2, False)
+        edge.replace_options(self.file.get_options(EDGE_OPTION, index))
+        return edge
+
+    def iter_edges(self):
+        for index in xrange(self.file.edge_count):
+            (id1, id2) = struct.unpack_from(
+                '<II', self.file.data, self.file.edges + 8 * index)
+            yield (Graph.get_edge_key(id1, id2), index)
+
+
+# DOT lines of a lazy mapping's items, rendered when asked for and not kept
+class RenderedLines(object):
+    def __init__(self, items, render):
+        self.items = items
+        self.render = render
+
+    def __iter__(self):
+        return self.items.iterkeys()
+
+    def __getitem__(self, key):
+        return self.render(self.items.peek(key))
+
+    def itervalues(self):
+        for item in self.items.itervalues():
+            yield self.render(item)
+
+
+# vertex id -> set of neighbor ids, a set made from the file row when first
+# asked for
+class LazyAdjacency(LazyMapping):
+    def __init__(self, graph_file):
+        LazyMapping.__init__(
+            self, graph_file, graph_file.vertex_count,
+            self.find_row, self.load_row, self.iter_rows)
+
+    def find_row(self, vertex_id):
+        return vertex_id if vertex_id < self.file.vertex_count else None
+
+    def load_row(self, vertex_id, index):
+        return set(self.file.get_neighbors(index))
+
+    def iter_rows(self):
+        for vertex_id in xrange(self.file.vertex_count):
+            yield (vertex_id, vertex_id)
+
+    def iteritems(self):
+        for vertex_id in self.iterkeys():
+            yield (vertex_id, self[vertex_id])
+
+# keys without reading the rows
+    def iterkeys(self):
+        for vertex_id in xrange(self.file.vertex_count):
+            if vertex_id not in self.removed:
+                yield vertex_id
+        for vertex_id in self.loaded:
+            if vertex_id >= self.file.vertex_count:
+                yield vertex_id
+
+    __iter__ = iterkeys
+
+
+# stack of deltas packed back to back in one buffer; entries evicted from the
+# bottom leave a dead prefix, which is dropped once it outgrows the live part
+class DeltaLog(object):
     def __init__(self):
-        self.undo = []
-        self.redo = []
+        self.buffer = bytearray()
+        self.offsets = array.array('L')
+        self.first = 0
+
+    def __len__(self):
+        return len(self.offsets) - self.first
+
+    def append(self, delta):
+        self.offsets.append(len(self.buffer))
+        self.buffer.extend(delta)
+
+    def pop(self):
+        offset = self.offsets.pop()
+        delta = str(self.buffer[offset:])
+        del self.buffer[offset:]
+        if not self:
+            self.clear()
+        return delta
+
+    def popleft(self):
+        start = self.offsets[self.first]
+        self.first += 1
+        if not self:
+            delta = str(self.buffer[start:])
+            self.clear()
+            return delta
+        end = self.offsets[self.first]
+        delta = str(self.buffer[start:end])
+        if end > self.get_size():
+            del self.buffer[:end]
+            self.offsets = array.array(
+                'L', (offset - end for offset in self.offsets[self.first:]))
+            self.first = 0
+        return delta
+
+    def clear(self):
+        self.buffer = bytearray()
+        self.offsets = array.array('L')
+        self.first = 0
+
+# bytes held by the live entries
+    def get_size(self):
+        if not self:
+            return 0
+        return len(self.buffer) - self.offsets[self.first]
+
+
+# on-disk stack of deltas; the top of the stack is the end of the file, so
+# loading a delta back just truncates the file
+class SpillFile(object):
+    def __init__(self, path):
+        self.file = open(path, 'w+b')
+        self.offsets = []
+        self.end = 0
 
-    def do_undo(self):
-        if not self.undo:
+    def __len__(self):
+        return len(self.offsets)
+
+    def push(self, delta):
+        self.file.seek(self.end)
+        self.file.write(delta)
+        self.offsets.append(self.end)
+        self.end += len(delta)
+
+    def pop(self):
+        offset = self.offsets.pop()
+        self.file.seek(offset)
+        delta = self.file.read(self.end - offset)
+        self.file.truncate(offset)
+        self.end = offset
+        return delta
+
+    def clear(self):
+        self.file.truncate(0)
+        self.offsets = []
+        self.end = 0
+
+
+class History(object):
+    def __init__(self, max_entries=None, max_bytes=None, spill_file=None):
+        self.undo = DeltaLog()
+        self.redo = DeltaLog()
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.undo_spill = None
+        self.redo_spill = None
+        if spill_file:
+            self.undo_spill = SpillFile(spill_file)
+            self.redo_spill = SpillFile(spill_file + '.redo')
+
+    def do_undo(self, graph):
+        delta = self.pop(self.undo, self.undo_spill)
+        if delta is None:
             raise IndexError('Nothing to undo')
-        act = self.undo.pop()
-        act.undo(act.params)
-        self.redo.append(act)
+        graph.replay_delta(delta, False)
+        self.push(self.redo, delta)
+        return delta
 
-    def do_redo(self):
-        if not self.redo:
+    def do_redo(self, graph):
+        delta = self.pop(self.redo, self.redo_spill)
+        if delta is None:
             raise IndexError('Nothing to redo')
-        act = self.redo.pop()
-        act.do(act.params)
-        self.undo.append(act)
+        graph.replay_delta(delta, True)
+        self.push(self.undo, delta)
+        return delta
 
-    def add(self, act):
-        self.undo.append(act)
+    def add(self, delta):
 # flush redo stack, if action called from command line
-        del self.redo[:]
+        self.redo.clear()
+        if self.redo_spill is not None:
+            self.redo_spill.clear()
+        self.push(self.undo, delta)
 
+    def clear(self):
+        self.undo.clear()
+        self.redo.clear()
+        for spill in (self.undo_spill, self.redo_spill):
+            if spill is not None:
+                spill.clear()
 
-class Document(object):
+    def push(self, stack, delta):
+        stack.append(delta)
+        self.trim()
+
+    def pop(self, stack, spill):
+        if stack:
+            return stack.pop()
+        if spill is not None and spill:
+            return spill.pop()
+        return None
+
+# keep memory within budget: the oldest undo entries and the farthest redo
+# entries go to the spill files, or are dropped if spilling is off; the
+# entry limit holds for each stack, the byte budget is taken from the larger
+# one, so that neither stack is emptied to make room for the other
+    def trim(self):
+        stacks = ((self.undo, self.undo_spill), (self.redo, self.redo_spill))
+        if self.max_entries is not None:
+            for (stack, spill) in stacks:
+                while len(stack) > self.max_entries:
+                    self.evict(stack, spill)
+        if self.max_bytes is not None:
+            while self.get_size() > self.max_bytes:
+                (stack, spill) = max(
+                    stacks, key=lambda pair: pair[0].get_size())
+                self.evict(stack, spill)
+
+    def evict(self, stack, spill):
+        delta = stack.popleft()
+        if spill is not None:
+            spill.push(delta)
+
+    def get_size(self):
+        return self.undo.get_size() + self.redo.get_size()
+
+    def get_stats(self):
+        spilled = 0
+        for spill in (self.undo_spill, self.redo_spill):
+            if spill is not None:
+                spilled += len(spill)
+        return {
+            'undo_entries': len(self.undo),
+            'redo_entries': len(self.redo),
+            'bytes': self.get_size(),
+            'spilled_entries': spilled,
+        }
+
+
+# journal record types: the checkpoint the journal continues, vertex names
+# for the ids used by the deltas that follow, deltas applied forwards
+# (edits and redo) or backwards (undo), and the number of vertices of the
+# checkpoint whose indices are the first ids, instead of their names
+JOURNAL_BEGIN = 1
+JOURNAL_NAMES = 2
+JOURNAL_FORWARD = 3
+JOURNAL_BACKWARD = 4
+JOURNAL_FILE_NAMES = 5
+JOURNAL_COUNT = struct.Struct('<I')
+# type, payload length and payload CRC-32, which detects a torn last record
+JOURNAL_RECORD = struct.Struct('<BII')
+# CRC-32 and size of the checkpoint file
+JOURNAL_CHECKPOINT = struct.Struct('<IQ')
+# seconds a journal record may wait for fsync, so that edits coming close
+# together share one
+JOURNAL_SYNC_INTERVAL = 0.05
+# journal size that triggers a new checkpoint
+CHECKPOINT_BYTES = 64 * 1024 * 1024
+FILE_READ_SIZE = 1024 * 1024
+
+
+def get_file_checksum(path):
+    checksum = 0
+    size = 0
+    with open(path, 'rb') as stream:
+        for data in iter(lambda: stream.read(FILE_READ_SIZE), ''):
+            checksum = zlib.crc32(data, checksum)
+            size += len(data)
+    return JOURNAL_CHECKPOINT.pack(checksum & 0xFFFFFFFF, size)
+
+
+def sync_file(path):
+    with open(path, 'rb') as stream:
+        os.fsync(stream.fileno())
+
+
+def sync_directory(path):
+    descriptor = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+        os.fsync(descriptor)
+    finally:
+        os.close(descriptor)
+
+
+# write-ahead log of graph changes next to a checkpoint in graph file format;
+# a session is restored by loading the checkpoint and replaying the journal,
+# and the journal starts over with each new checkpoint
+class Journal(object):
+    def __init__(self, path, sync_interval=JOURNAL_SYNC_INTERVAL,
+                 checkpoint_bytes=CHECKPOINT_BYTES):
+        self.path = path
+        self.checkpoint_path = path + '.checkpoint'
+        self.sync_interval = sync_interval
+        self.checkpoint_bytes = checkpoint_bytes
+        self.file = None
+        self.size = 0
+        self.names_written = 0
+        self.unsynced = False
+        self.synced_at = 0
+# records that come within sync_interval of the last fsync are synced by a
+# timer, so none waits longer than that even if no edit follows
+        self.timer = None
+        self.lock = threading.RLock()
+
+    def recover(self, name):
+        if os.path.exists(self.checkpoint_path):
+            graph_file = GraphFile(self.checkpoint_path)
+            try:
+                graph = graph_file.to_graph()
+            finally:
+                graph_file.close()
+        else:
+            graph = Graph(name)
+        if os.path.exists(self.path):
+            self.replay(graph)
+# ids of the restored graph differ from the ones in the journal, so
+# further records go to a new journal
+        self.checkpoint(graph)
+        return graph
+
+    def replay(self, graph):
+        names = []
+        records = self.read_records()
+        first = next(records, None)
+        if first is None or first[0] != JOURNAL_BEGIN:
+            return
+# a journal left from before the last checkpoint is already part of it
+        if not os.path.exists(self.checkpoint_path) or (
+                first[1] != get_file_checksum(self.checkpoint_path)):
+            return
+        for (record_type, payload) in records:
+            if record_type == JOURNAL_NAMES:
+                names.extend(payload.split('\n'))
+            elif record_type == JOURNAL_FILE_NAMES:
+                (count,) = JOURNAL_COUNT.unpack(payload)
+                graph_file = GraphFile(self.checkpoint_path)
+                try:
+                    names.extend(graph_file.get_vertex_name(index)
+                                 for index in xrange(count))
+                finally:
+                    graph_file.close()
+            else:
+                graph.replay_delta(
+                    payload, record_type == JOURNAL_FORWARD, names)
+
+# stops at the first incomplete or damaged record
+    def read_records(self):
+        with open(self.path, 'rb') as stream:
+            while True:
+                header = stream.read(JOURNAL_RECORD.size)
+                if len(header) < JOURNAL_RECORD.size:
+                    return
+                (record_type, length, checksum) = JOURNAL_RECORD.unpack(header)
+                payload = stream.read(length)
+                if len(payload) < length or (
+                        zlib.crc32(payload) & 0xFFFFFFFF) != checksum:
+                    return
+                yield (record_type, payload)
+
+    def append(self, graph, record_type, delta):
+        with self.lock:
+            self.write_names(graph)
+            self.write_record(record_type, delta)
+            self.file.flush()
+            self.unsynced = True
+            wait = self.synced_at + self.sync_interval - time.time()
+            if wait <= 0:
+                self.sync()
+            elif self.timer is None:
+                self.timer = threading.Timer(wait, self.sync_pending)
+                self.timer.daemon = True
+                self.timer.start()
+
+# kept apart from append: a failing checkpoint must not take back a change
+# whose record is already written
+    def compact(self, graph):
+        if self.size >= self.checkpoint_bytes:
+            self.checkpoint(graph)
+
+# names interned since the last record
+    def write_names(self, graph):
+        names = graph.vertex_names
+        if len(names) > self.names_written:
+            self.write_record(
+                JOURNAL_NAMES, '\n'.join(names[self.names_written:]))
+            self.names_written = len(names)
+
+    def write_record(self, record_type, payload):
+        self.file.write(JOURNAL_RECORD.pack(
+            record_type, len(payload), zlib.crc32(payload) & 0xFFFFFFFF))
+        self.file.write(payload)
+        self.size += JOURNAL_RECORD.size + len(payload)
+
+    def sync(self):
+        if self.unsynced:
+            os.fsync(self.file.fileno())
+            self.unsynced = False
+        self.synced_at = time.time()
+
+    def sync_pending(self):
+        with self.lock:
+            self.timer = None
+            if self.file is not None:
+                self.sync()
+
+# the new checkpoint is in place before the new journal, and a journal is
+# only replayed over the checkpoint it begins with
+    def checkpoint(self, graph):
+        with self.lock:
+            self.write_checkpoint(graph)
+
+    def write_checkpoint(self, graph):
+        checkpoint_path = self.checkpoint_path + '.tmp'
+        write_graph_file(graph, checkpoint_path)
+        sync_file(checkpoint_path)
+        self.start(graph, checkpoint_path, 0)
+
+# a graph just opened lazily from a graph file is that file: it becomes the
+# checkpoint as it is, linked (or copied) instead of written out again, and
+# its vertex indices, the ids of the lazy graph, need no names record
+    def checkpoint_file(self, graph, path, vertex_count):
+        with self.lock:
+            checkpoint_path = self.checkpoint_path + '.tmp'
+            if os.path.exists(checkpoint_path):
+                os.remove(checkpoint_path)
+            try:
+                os.link(path, checkpoint_path)
+            except OSError:
+                shutil.copyfile(path, checkpoint_path)
+            sync_file(checkpoint_path)
+            self.start(graph, checkpoint_path, vertex_count)
+
+    def start(self, graph, checkpoint_path, file_names):
+        journal_path = self.path + '.tmp'
+        if self.file is not None:
+            self.file.close()
+        self.file = open(journal_path, 'wb')
+        self.size = 0
+        self.write_record(JOURNAL_BEGIN, get_file_checksum(checkpoint_path))
+        self.names_written = 0
+        if file_names:
+            self.write_record(
+                JOURNAL_FILE_NAMES, JOURNAL_COUNT.pack(file_names))
+            self.names_written = file_names
+        self.write_names(graph)
+        self.file.flush()
+        self.unsynced = True
+        self.sync()
+        os.rename(checkpoint_path, self.checkpoint_path)
+        os.rename(journal_path, self.path)
+        sync_directory(self.path)
+
+    def close(self):
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            if self.file is not None:
+                self.sync()
+                self.file.close()
+                self.file = None
+
+
+# latency histogram: bucket i counts calls that took less than 2**i
+# microseconds, the last one also everything slower
+STATS_BUCKETS = 32
+
+
+class Timer(object):
+    __slots__ = ('count', 'seconds', 'objects', 'buckets')
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.objects = 0
+        self.buckets = [0] * STATS_BUCKETS
+
+    def add(self, seconds, objects):
+        self.count += 1
+        self.seconds += seconds
+        self.objects += objects
+        bucket = int(seconds * 1000000).bit_length()
+        self.buckets[min(bucket, STATS_BUCKETS - 1)] += 1
+
+# upper bound, in microseconds, of the bucket the given share of calls fits in
+    def get_percentile(self, share):
+        seen = 0
+        for (i, count) in enumerate(self.buckets):
+            seen += count
+            if seen >= share * self.count:
+                return 2 ** i
+        return 2 ** (STATS_BUCKETS - 1)
+
+    def to_dict(self):
+        return {
+            'count': self.count,
+            'seconds': self.seconds,
+            'objects': self.objects,
+            'histogram': dict((str(2 ** i), count)
+                              for (i, count) in enumerate(self.buckets)
+                              if count),
+        }
+
+
+# opt-in timing of chosen functions: nothing is wrapped, so nothing costs,
+# until they are handed to wrap() or instrument(); times are inclusive of
+# the instrumented calls made inside
+class Stats(object):
     def __init__(self):
-        self.graph = Graph('mygraph')
-        self.history = History()
+        self.timers = {}
+
+    def wrap(self, name, function):
+        timer = self.timers.setdefault(name, Timer())
+
+# the GC counts container objects created minus those freed, and resets
+# the count on every collection, so collections wait until the call is over;
+# the result is net growth, which is negative for calls that free objects
+        def timed(*args, **kwargs):
+            enabled = gc.isenabled()
+            gc.disable()
+            objects = gc.get_count()[0]
+            started = time.time()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                timer.add(time.time() - started,
+                          gc.get_count()[0] - objects)
+                if enabled:
+                    gc.enable()
+        timed.__name__ = function.__name__
+        return timed
+
+# wraps the methods of one object, so that other documents (and other
+# graphs of this one) are left alone
+    def instrument(self, obj, prefix, names):
+        for name in names:
+            setattr(obj, name, self.wrap(prefix + name, getattr(obj, name)))
+
+    def to_dict(self, history):
+        return {
+            'timers': dict((name, timer.to_dict())
+                           for (name, timer) in self.timers.iteritems()
+                           if timer.count),
+            'history': history.get_stats(),
+        }
+
+    def write_report(self, stream, history):
+        stream.write('%-32s %8s %10s %9s %8s %8s %9s\n' % (
+            'name', 'calls', 'total ms', 'mean us', 'p50 us', 'p99 us',
+            'objects'))
+        timers = sorted(self.timers.iteritems(),
+                        key=lambda item: -item[1].seconds)
+        for (name, timer) in timers:
+            if not timer.count:
+                continue
+            stream.write('%-32s %8d %10.1f %9.1f %8d %8d %9d\n' % (
+                name, timer.count, timer.seconds * 1000,
+                timer.seconds * 1000000 / timer.count,
+                timer.get_percentile(0.5), timer.get_percentile(0.99),
+                timer.objects))
+        items = sorted(history.get_stats().iteritems())
+        stream.write('history: %s\n' % ', '.join(
+            '%s %s' % (key, value) for (key, value) in items))
+
+
+class Document(object):
+    def __init__(self, name='mygraph', journal=None, **history_options):
+        self.journal = journal
+        if journal is not None:
+            self.graph = journal.recover(name)
+        else:
+            self.graph = Graph(name)
+        self.history = History(**history_options)
+# where command output goes
+        self.output = sys.stdout
+# Stats, if switched on
+        self.stats = None
 
     def exit(self, *args):
-        print 'Nooooooooo\n'
+        print >> self.output, 'Nooooooooo\n'
+        self.close()
         sys.exit(0)
 
+    def close(self):
+        if self.journal is not None:
+            self.journal.close()
+
+# the change is journaled before the command counts as done; if that fails,
+# it is taken back
+    def record_edit(self, delta):
+        if self.journal is not None:
+            try:
+                self.journal.append(self.graph, JOURNAL_FORWARD, delta)
+            except Exception:
+                self.graph.replay_delta(delta, False)
+                raise
+        self.history.add(delta)
+        if self.journal is not None:
+            self.journal.compact(self.graph)
+
     def add_vertex(self, obj):
         self.graph.add_vertex(obj.name)
 
@@ -190,9 +2332,74 @@ class Document(object):
     def remove_vertex_attribute(self, obj):
         self.graph.remove_vertex_attribute(obj.name, obj.key)
 
-    def print_graph(self, *args):
-        printable_graph = self.graph.get_dot_graph()
-        sys.stdout.write(printable_graph)
+    def print_graph(self, obj):
+        self.graph.write_dot(self.output, obj.sorted)
+
+    def print_neighbors(self, obj):
+        neighbors = sorted(self.graph.get_neighbors(obj.name))
+        print >> self.output, ' '.join(neighbors)
+
+    def print_degree(self, obj):
+        print >> self.output, self.graph.get_degree(obj.name)
+
+    def print_path(self, obj):
+        path = self.graph.get_shortest_path(obj.name1, obj.name2, obj.weight)
+        if path is None:
+            print >> self.output, 'No path between %s and %s' % (
+                obj.name1, obj.name2)
+        else:
+            print >> self.output, '%s (%s)' % (' -- '.join(path[0]), path[1])
+
+    def print_components(self, obj):
+        components = sorted(sorted(c) for c in self.graph.get_components())
+        print >> self.output, '%d components' % len(components)
+        for component in components:
+            print >> self.output, ' '.join(component)
+
+    def print_connected(self, obj):
+        connected = self.graph.is_connected(obj.name1, obj.name2)
+        print >> self.output, 'yes' if connected else 'no'
+
+    def index(self, obj):
+        if obj.kind == 'vertex':
+            if obj.drop:
+                self.graph.remove_vertex_index(obj.key)
+            else:
+                self.graph.add_vertex_index(obj.key)
+        elif obj.kind == 'edge':
+            if obj.drop:
+                self.graph.remove_edge_index(obj.key)
+            else:
+                self.graph.add_edge_index(obj.key)
+        else:
+            raise AttributeError('Unknown item kind %s' % obj.kind)
+
+    def find(self, obj):
+        if obj.kind == 'vertex':
+            for name in self.graph.find_vertices(
+                    obj.key, obj.value, obj.prefix):
+                print >> self.output, name
+        elif obj.kind == 'edge':
+            for (name1, name2) in self.graph.find_edges(
+                    obj.key, obj.value, obj.prefix):
+                print >> self.output, name1, '--', name2
+        else:
+            raise AttributeError('Unknown item kind %s' % obj.kind)
+
+    def print_degree_histogram(self, obj):
+        histogram = self.graph.get_csr().get_degree_histogram()
+        for (degree, count) in enumerate(histogram):
+            if count:
+                print >> self.output, degree, count
+
+    def print_pagerank(self, obj):
+        csr = self.graph.get_csr()
+        rank = csr.get_pagerank()
+        for i in numpy.argsort(-rank)[:obj.top]:
+            print >> self.output, csr.names[i], '%.6f' % rank[i]
+
+    def print_triangles(self, obj):
+        print >> self.output, self.graph.get_csr().count_triangles()
 
     def add_edge(self, obj):
         self.graph.add_edge(obj.name1, obj.name2)
@@ -206,77 +2413,362 @@ class Document(object):
     def remove_edge_attribute(self, obj):
         self.graph.remove_edge_attribute(obj.name1, obj.name2, obj.key)
 
+    def save(self, obj):
+        write_graph_file(self.graph, obj.file)
+
+# opening a file starts a new editing session
+    def open_graph(self, obj):
+        graph_file = GraphFile(obj.file)
+        if obj.lazy:
+            self.graph = graph_file.to_lazy_graph()
+        else:
+            try:
+                self.graph = graph_file.to_graph()
+            finally:
+                graph_file.close()
+        if self.stats is not None:
+            self.stats.instrument(self.graph, 'graph.', GRAPH_STATS_METHODS)
+        self.history.clear()
+        if self.journal is not None and obj.lazy:
+            self.journal.checkpoint_file(
+                self.graph, obj.file, graph_file.vertex_count)
+        elif self.journal is not None:
+            self.journal.checkpoint(self.graph)
+
+    def import_graph(self, obj):
+        file_format = obj.format or get_file_format(obj.file)
+        if obj.jobs > 1:
+            batches = read_graph_file_parallel(obj.file, file_format, obj.jobs)
+            self.graph.bulk_import(batches, False)
+        else:
+            self.graph.bulk_import(read_graph_file(obj.file, file_format))
+
+    def show_stats(self, obj):
+        if self.stats is None:
+            raise AttributeError('Statistics are off, start with --stats')
+        if obj.json:
+            with open(obj.json, 'w') as stream:
+                json.dump(self.stats.to_dict(self.history), stream,
+                          indent=1, sort_keys=True)
+        else:
+            self.stats.write_report(self.output, self.history)
+
+# like edits, undo and redo are taken back if they can't be journaled
     def undo(self, *args):
-        self.history.do_undo()
+        delta = self.history.do_undo(self.graph)
+        if self.journal is not None:
+            try:
+                self.journal.append(self.graph, JOURNAL_BACKWARD, delta)
+            except Exception:
+                self.history.do_redo(self.graph)
+                raise
+            self.journal.compact(self.graph)
 
     def redo(self, *args):
-        self.history.do_redo()
+        delta = self.history.do_redo(self.graph)
+        if self.journal is not None:
+            try:
+                self.journal.append(self.graph, JOURNAL_FORWARD, delta)
+            except Exception:
+                self.history.do_undo(self.graph)
+                raise
+            self.journal.compact(self.graph)
+
+
+# subcommands as (name, help, arguments, Document method, undoable); every
+# argument is a name (a flag for options) with add_argument keyword arguments
+COMMANDS = (
+    ('add_vertex', 'vertex adding', [('name', {})], 'add_vertex', True),
+    ('remove_vertex', 'vertex deleting', [('name', {})], 'remove_vertex',
+     True),
+    ('set_vertex_attribute', 'setting vertex attribute',
+     [('name', {}), ('key', {}), ('value', {})], 'set_vertex_attribute',
+     True),
+    ('add_edge', 'edge adding', [('name1', {}), ('name2', {})], 'add_edge',
+     True),
+    ('remove_edge', 'edge deleting', [('name1', {}), ('name2', {})],
+     'remove_edge', True),
+    ('set_edge_attribute', 'setting edge attribute',
+     [('name1', {}), ('name2', {}), ('key', {}), ('value', {})],
+     'set_edge_attribute', True),
+    ('import', 'loading vertices and edges from a file', [
+        ('file', {}),
+        ('--format', {
+            'choices': ['dot', 'edges'],
+            'help': 'file format (by default .dot and .gv files are DOT)'}),
+        ('--jobs', {
+            'type': int, 'default': 1, 'metavar': 'N',
+            'help': 'worker processes reading the file'}),
+    ], 'import_graph', True),
+    ('save', 'saving to a graph file', [('file', {})], 'save', False),
+    ('open', 'opening a graph file', [
+        ('file', {}),
+        ('--lazy', {
+            'action': 'store_true',
+            'help': 'read elements from the file when they are used'}),
+    ], 'open_graph', False),
+    ('undo', 'undo the last action', [], 'undo', False),
+    ('redo', 'redo the last action', [], 'redo', False),
+    ('print', 'graph printing', [
+        ('--sorted', {'action': 'store_true', 'help': 'print in name order'}),
+    ], 'print_graph', False),
+    ('neighbors', 'vertex neighbors', [('name', {})], 'print_neighbors',
+     False),
+    ('degree', 'vertex degree', [('name', {})], 'print_degree', False),
+    ('path', 'shortest path', [
+        ('name1', {}),
+        ('name2', {}),
+        ('--weight', {
+            'metavar': 'KEY',
+            'help': 'numeric edge option to use as length '
+                    '(edge count by default)'}),
+    ], 'print_path', False),
+    ('components', 'connected components', [], 'print_components', False),
+    ('connected', 'checking if two vertices are connected',
+     [('name1', {}), ('name2', {})], 'print_connected', False),
+    ('index', 'indexing an option key for find', [
+        ('kind', {'choices': ['vertex', 'edge']}),
+        ('key', {}),
+        ('--drop', {
+            'action': 'store_true', 'help': 'remove the index instead'}),
+    ], 'index', False),
+    ('find', 'vertices or edges by option value', [
+        ('kind', {'choices': ['vertex', 'edge']}),
+        ('key', {}),
+        ('value', {}),
+        ('--prefix', {
+            'action': 'store_true',
+            'help': 'match values starting with VALUE'}),
+    ], 'find', False),
+    ('degree_histogram', 'vertex count for every degree (NumPy)', [],
+     'print_degree_histogram', False),
+    ('pagerank', 'vertices with the highest PageRank (NumPy)', [
+        ('--top', {
+            'type': int, 'default': 10, 'metavar': 'N',
+            'help': 'vertices to show'}),
+    ], 'print_pagerank', False),
+    ('triangles', 'triangle count (NumPy)', [], 'print_triangles', False),
+    ('stats', 'command, graph and history statistics (--stats)', [
+        ('--json', {'metavar': 'FILE', 'help': 'write them to FILE as JSON'}),
+    ], 'show_stats', False),
+    ('exit', 'exits the editor', [], 'exit', False),
+)
+
+
+# help and usage errors go to the document's output when it isn't stdout,
+# so that a served document answers them to its client
+class DocumentParser(argparse.ArgumentParser):
+    def __init__(self, doc, **kwargs):
+        argparse.ArgumentParser.__init__(self, **kwargs)
+        self.doc = doc
+
+    def _print_message(self, message, file=None):
+        if self.doc.output is not sys.stdout:
+            file = self.doc.output
+        argparse.ArgumentParser._print_message(self, message, file)
 
 
 def get_parser(doc):
-    parser = argparse.ArgumentParser()
-    subparsers = parser.add_subparsers(title="Commands", metavar="<command>")
-
-    p_va = subparsers.add_parser('add_vertex', help='vertex adding')
-    p_va.add_argument('name')
-    p_va.set_defaults(func=doc.add_vertex, antifunc=doc.remove_vertex)
-
-    p_rv = subparsers.add_parser('remove_vertex', help='vertex deleting')
-    p_rv.add_argument('name')
-    p_rv.set_defaults(func=doc.remove_vertex, antifunc=doc.add_vertex)
-
-    p_sva = subparsers.add_parser(
-        'set_vertex_attribute', help='setting vertex attribute')
-    p_sva.add_argument('name')
-    p_sva.add_argument('key')
-    p_sva.add_argument('value')
-    p_sva.set_defaults(
-        func=doc.set_vertex_attribute,
-        antifunc=doc.remove_vertex_attribute
-    )
+    parser = DocumentParser(doc)
+    subparsers = parser.add_subparsers(
+        title="Commands", metavar="<command>",
+        parser_class=lambda **kwargs: DocumentParser(doc, **kwargs))
+    for (name, help_text, arguments, method, has_undo) in COMMANDS:
+        subparser = subparsers.add_parser(name, help=help_text)
+        for (argument, options) in arguments:
+            subparser.add_argument(argument, **options)
+        subparser.set_defaults(func=getattr(doc, method), has_undo=has_undo)
+    return parser
+
+
+# command name -> (positional fields with their choices, defaults), made
+# straight from COMMANDS; the argparse parser, only needed for lines with
+# options or asking for help, is built on first use
+class CommandTable(dict):
+    def __init__(self, get_parser):
+        dict.__init__(self)
+        self.get_parser = get_parser
+        self.parser = None
+
+    def parse_args(self, words):
+        if self.parser is None:
+            self.parser = self.get_parser()
+        return self.parser.parse_args(words)
+
+
+def get_table_entry(arguments, defaults):
+    fields = []
+    for (argument, options) in arguments:
+        if argument.startswith('-'):
+            default = options.get('default')
+            if default is None and options.get('action') == 'store_true':
+                default = False
+            defaults[argument.lstrip('-').replace('-', '_')] = default
+        else:
+            fields.append((argument, options.get('choices')))
+    return (fields, defaults)
+
+
+def get_command_table(doc):
+    table = CommandTable(lambda: get_parser(doc))
+    for (name, help_text, arguments, method, has_undo) in COMMANDS:
+        table[name] = get_table_entry(
+            arguments, {'func': getattr(doc, method), 'has_undo': has_undo})
+    return table
+
+
+def parse_command(table, words):
+    entry = table.get(words[0])
+    if entry is None and not words[0].startswith('-'):
+        raise ValueError('Unknown command %s' % words[0])
+    if entry is not None and not any(
+            word.startswith('-') for word in words[1:]):
+        (fields, defaults) = entry
+        if len(words) - 1 != len(fields):
+            raise ValueError(
+                '%s takes %d arguments' % (words[0], len(fields)))
+        args = argparse.Namespace(**defaults)
+        for ((field, choices), word) in zip(fields, words[1:]):
+            if choices is not None and word not in choices:
+                raise ValueError(
+                    '%s must be one of %s' % (field, ', '.join(choices)))
+            setattr(args, field, word)
+        return args
+# options and help go through argparse
+    try:
+        return table.parse_args(words)
+    except SystemExit, e:
+        if e.code:
+            raise ValueError('Bad arguments for %s' % words[0])
+# argparse has printed the help
+    return argparse.Namespace(func=lambda args: None, has_undo=False)
 
-    p_ae = subparsers.add_parser('add_edge', help='edge adding')
-    p_ae.add_argument('name1')
-    p_ae.add_argument('name2')
-    p_ae.set_defaults(func=doc.add_edge, antifunc=doc.remove_edge)
-
-    p_re = subparsers.add_parser('remove_edge', help='edge deleting')
-    p_re.add_argument('name1')
-    p_re.add_argument('name2')
-    p_re.set_defaults(func=doc.remove_edge, antifunc=doc.add_edge)
-
-    p_sea = subparsers.add_parser(
-        'set_edge_attribute', help='setting edge attribute')
-    p_sea.add_argument('name1')
-    p_sea.add_argument('name2')
-    p_sea.add_argument('key')
-    p_sea.add_argument('value')
-    p_sea.set_defaults(
-        func=doc.set_edge_attribute,
-        antifunc=doc.remove_edge_attribute
-    )
 
-    p_undo = subparsers.add_parser('undo', help='undo the last action')
-    p_undo.set_defaults(func=doc.undo, antifunc=None)
+def run_command(doc, args):
+    if not args.has_undo:
+        args.func(args)
+        return
+    graph = doc.graph
+    graph.delta = DeltaWriter()
+    try:
+        args.func(args)
+        delta = graph.delta.getvalue()
+    finally:
+        graph.delta = None
+    if delta:
+        doc.record_edit(delta)
 
-    p_redo = subparsers.add_parser('redo', help='redo the last action')
-    p_redo.set_defaults(func=doc.redo, antifunc=None)
 
-    p_pg = subparsers.add_parser('print', help='graph printing')
-    p_pg.set_defaults(func=doc.print_graph, antifunc=None)
+GRAPH_STATS_METHODS = (
+    'add_vertex', 'remove_vertex', 'set_vertex_attribute',
+    'remove_vertex_attribute', 'add_edge', 'remove_edge',
+    'set_edge_attribute', 'remove_edge_attribute', 'bulk_import',
+    'replay_delta',
+)
+HISTORY_STATS_METHODS = ('add', 'do_undo', 'do_redo', 'trim')
 
-    p_exit = subparsers.add_parser('exit', help='exits the editor')
-    p_exit.set_defaults(func=doc.exit, antifunc=None)
+
+# times every command, Graph mutations and History operations of one
+# document; commands are timed through the Document methods, so this goes
+# before get_command_table
+def enable_stats(doc):
+    if doc.stats is not None:
+        return
+    stats = Stats()
+    for (name, help_text, arguments, method, has_undo) in COMMANDS:
+        setattr(doc, method,
+                stats.wrap('command.' + name, getattr(doc, method)))
+    stats.instrument(doc.graph, 'graph.', GRAPH_STATS_METHODS)
+    stats.instrument(doc.history, 'history.', HISTORY_STATS_METHODS)
+    doc.stats = stats
+
+
+def run_script(doc, stream, table):
+    count = 0
+    errors = 0
+# bulk runs allocate lots of long-living objects and no garbage cycles
+    gc.disable()
+    started = time.time()
+    try:
+        for (line_no, line) in enumerate(stream, 1):
+            words = line.split()
+            if not words or words[0].startswith('#'):
+                continue
+            count += 1
+            try:
+                run_command(doc, parse_command(table, words))
+            except Exception, e:
+                errors += 1
+                sys.stderr.write('line %d: %s\n' % (line_no, e))
+    finally:
+        gc.enable()
+    elapsed = time.time() - started
+    sys.stderr.write('%d commands in %.3f s (%d/s), %d errors\n' % (
+        count, elapsed, count / elapsed if elapsed else 0, errors))
+    return errors
+
+
+def get_cli_parser():
+    parser = argparse.ArgumentParser()
+    add_history_arguments(parser)
+    parser.add_argument(
+        '--script', metavar='FILE',
+        help="run commands from FILE ('-' for stdin) without the prompt")
+    parser.add_argument(
+        '--stats', action='store_true',
+        help="time commands and graph operations (see 'stats')")
+    parser.add_argument(
+        '--journal', metavar='FILE',
+        help='journal edits to FILE and restore the session from it')
+    parser.add_argument(
+        '--journal-sync', type=float, default=JOURNAL_SYNC_INTERVAL,
+        metavar='SECONDS', help='longest wait of a journaled edit for fsync')
+    parser.add_argument(
+        '--checkpoint-bytes', type=int, default=CHECKPOINT_BYTES,
+        metavar='N', help='journal size that makes a new checkpoint')
     return parser
 
+
+def add_history_arguments(parser):
+    parser.add_argument(
+        '--history-entries', type=int, metavar='N',
+        help='undo steps kept in memory')
+    parser.add_argument(
+        '--history-bytes', type=int, metavar='N',
+        help='memory budget for undo steps')
+    parser.add_argument(
+        '--history-spill', metavar='FILE',
+        help='spill old undo steps to FILE instead of dropping them')
+
+
+def get_history_options(options):
+    return {
+        'max_entries': options.history_entries,
+        'max_bytes': options.history_bytes,
+        'spill_file': options.history_spill,
+    }
+
 if __name__ == '__main__':
-    mydoc = Document()
-    parser = get_parser(mydoc)
+    options = get_cli_parser().parse_args()
+    journal = None
+    if options.journal:
+        journal = Journal(
+            options.journal, options.journal_sync, options.checkpoint_bytes)
+    mydoc = Document(journal=journal, **get_history_options(options))
+    if options.stats:
+        enable_stats(mydoc)
+    table = get_command_table(mydoc)
+    if options.script or not sys.stdin.isatty():
+        stream = sys.stdin
+        if options.script not in (None, '-'):
+            stream = open(options.script)
+        errors = run_script(mydoc, stream, table)
+        mydoc.close()
+        sys.exit(1 if errors else 0)
     while True:
         try:
-            args = parser.parse_args(raw_input('\n>>> Enter action: ').split())
-            args.func(args)
-            if args.antifunc:
-                mydoc.history.add(Activity(args.func, args.antifunc, args))
+            words = raw_input('\n>>> Enter action: ').split()
+            if words:
+                run_command(mydoc, parse_command(table, words))
         except Exception, e:
             print e
@@ -2,8 +2,16 @@
 import sys
 import re
 import argparse
+import collections
+import cPickle
+import gc
+import json
+import time
 import copy
 
+# history checkpoints kept at most; the oldest go first
+MAX_CHECKPOINTS = 16
+
 
 class Item(object):
     def __init__():
@@ -60,11 +68,15 @@ class Edge(Item):
 
 
 class Graph(object):
-    def __init__(self, name):
+    def __init__(self, name, **history_options):
         self.name = name
         self.vertex_list = {}
         self.edge_list = {}
-        self.history = History()
+# incidence index: vertex name -> set of neighbor names
+        self.adjacency_list = {}
+        self.history = History(target=self, **history_options)
+# Stats, if switched on
+        self.stats = None
 
     def has_vertex(self, name):
         return True if name in self.vertex_list else False
@@ -73,14 +85,26 @@ class Graph(object):
         if self.has_vertex(name):
             raise AttributeError('Graph has vertex with name %s' % name)
         self.vertex_list[name] = Vertex(name)
+        self.adjacency_list[name] = set()
 
     def remove_vertex(self, name):
         if not self.has_vertex(name):
             raise AttributeError('No vertex in graph with name %s' % name)
         del self.vertex_list[name]
-        for key in self.edge_list.keys():
-            if self.edge_list[key].has_vertex(name):
-                del self.edge_list[key]
+        for neighbor in self.adjacency_list.pop(name):
+            del self.edge_list[Edge.get_edge_name(name, neighbor)]
+            if neighbor != name:
+                self.adjacency_list[neighbor].discard(name)
+
+    def get_degree(self, name):
+        if not self.has_vertex(name):
+            raise AttributeError('No vertex in graph with name %s' % name)
+        return len(self.adjacency_list[name])
+
+    def get_neighbors(self, name):
+        if not self.has_vertex(name):
+            raise AttributeError('No vertex in graph with name %s' % name)
+        return list(self.adjacency_list[name])
 
     def set_vertex_attribute(self, name, key, value):
         vertex = self.get_vertex(name)
@@ -103,11 +127,15 @@ class Graph(object):
         if self.has_edge(name1, name2):
             raise AttributeError('Graph has edge %s -- %s' % (name1, name2))
         self.edge_list[Edge.get_edge_name(name1, name2)] = Edge(name1, name2)
+        self.adjacency_list[name1].add(name2)
+        self.adjacency_list[name2].add(name1)
 
     def remove_edge(self, name1, name2):
         if not self.has_edge(name1, name2):
             raise AttributeError('No edge between %s and %s' % (name1, name2))
         del self.edge_list[Edge.get_edge_name(name1, name2)]
+        self.adjacency_list[name1].discard(name2)
+        self.adjacency_list[name2].discard(name1)
 
     def get_vertex(self, name):
         if not self.has_vertex(name):
@@ -127,6 +155,22 @@ class Graph(object):
         edge = self.get_edge(name1, name2)
         edge.remove_option(key)
 
+# vertices and edges as one pickled string, for history checkpoints
+    def get_state(self):
+        return cPickle.dumps(
+            (self.vertex_list, self.edge_list, self.adjacency_list),
+            cPickle.HIGHEST_PROTOCOL)
+
+    def set_state(self, state):
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            (self.vertex_list, self.edge_list,
+             self.adjacency_list) = cPickle.loads(state)
+        finally:
+            if gc_enabled:
+                gc.enable()
+
     def get_dot_graph(self):
         buffer = ['graph ', self.name, ' {\n']
         for k, v in self.vertex_list.iteritems():
@@ -140,98 +184,209 @@ class Graph(object):
 
 
 class Command(object):
+    __slots__ = ()
+
     def execute():
         raise NotImplemented()
 
 
+# undoable commands stay in history, so they keep only the fields they need
+# instead of the whole argparse namespace
 class UndoableCommand(Command):
+    __slots__ = ('target',)
+
     def unexecute():
         raise NotImplemented()
 
+# folds a later command into this one; returns False if it can't
+    def merge(self, command):
+        return False
+
+    def get_size(self):
+        return sys.getsizeof(self) + sum(
+            sys.getsizeof(getattr(self, field)) for field in self.__slots__
+            if isinstance(getattr(self, field), basestring))
+
 
 class AddVertex(UndoableCommand):
+    __slots__ = ('name',)
+
     def __init__(self, target, params):
         self.target = target
-        self.params = params
+        self.name = params.name
 
     def execute(self):
-        self.target.add_vertex(self.params.name)
+        self.target.add_vertex(self.name)
 
     def unexecute(self):
-        self.target.remove_vertex(self.params.name)
+        self.target.remove_vertex(self.name)
 
 
+# execute keeps the options and the incident edges, for unexecute to put
+# them back
 class RemoveVertex(UndoableCommand):
+    __slots__ = ('name', 'options', 'edges')
+
     def __init__(self, target, params):
         self.target = target
-        self.params = params
+        self.name = params.name
+        self.options = None
+        self.edges = None
 
     def execute(self):
-        self.target.remove_vertex(self.params.name)
+        graph = self.target
+        self.options = dict(graph.get_vertex(self.name).options)
+        self.edges = []
+        for neighbor in graph.get_neighbors(self.name):
+            edge = graph.get_edge(self.name, neighbor)
+            self.edges.append((edge.name1, edge.name2, dict(edge.options)))
+        graph.remove_vertex(self.name)
 
     def unexecute(self):
-        self.target.add_vertex(self.params.name)
+        graph = self.target
+        graph.add_vertex(self.name)
+        graph.get_vertex(self.name).options.update(self.options)
+        for (name1, name2, options) in self.edges:
+            graph.add_edge(name1, name2)
+            graph.get_edge(name1, name2).options.update(options)
+
+    def get_size(self):
+        edges = self.edges or []
+        return UndoableCommand.get_size(self) + sys.getsizeof(
+            self.options) + sys.getsizeof(edges) + sum(
+            sys.getsizeof(options) for (name1, name2, options) in edges)
 
 
+# old is the value before execute, None if the option was not set
 class SetVertexAttribute(UndoableCommand):
+    __slots__ = ('name', 'key', 'value', 'old')
+
     def __init__(self, target, params):
         self.target = target
-        self.params = params
+        self.name = params.name
+        self.key = params.key
+        self.value = params.value
+        self.old = None
 
     def execute(self):
-        self.target.set_vertex_attribute(
-            self.params.name,
-            self.params.key,
-            self.params.value
-        )
+        self.old = self.target.get_vertex(self.name).options.get(self.key)
+        self.target.set_vertex_attribute(self.name, self.key, self.value)
 
     def unexecute(self):
-        self.target.remove_vertex_attribute(self.params.name, self.params.key)
+        if self.old is None:
+            self.target.remove_vertex_attribute(self.name, self.key)
+        else:
+            self.target.set_vertex_attribute(self.name, self.key, self.old)
+
+    def merge(self, command):
+        if type(command) is not SetVertexAttribute:
+            return False
+        if (command.name, command.key) != (self.name, self.key):
+            return False
+        self.value = command.value
+        return True
 
 
 class AddEdge(UndoableCommand):
+    __slots__ = ('name1', 'name2')
+
     def __init__(self, target, params):
         self.target = target
-        self.params = params
+        self.name1 = params.name1
+        self.name2 = params.name2
 
     def execute(self):
-        self.target.add_edge(self.params.name1, self.params.name2)
+        self.target.add_edge(self.name1, self.name2)
 
     def unexecute(self):
-        self.target.remove_edge(self.params.name1, self.params.name2)
+        self.target.remove_edge(self.name1, self.name2)
 
 
 class RemoveEdge(UndoableCommand):
+    __slots__ = ('name1', 'name2', 'options')
+
     def __init__(self, target, params):
         self.target = target
-        self.params = params
+        self.name1 = params.name1
+        self.name2 = params.name2
+        self.options = None
 
     def execute(self):
-        self.target.remove_edge(self.params.name1, self.params.name2)
+        self.options = dict(
+            self.target.get_edge(self.name1, self.name2).options)
+        self.target.remove_edge(self.name1, self.name2)
 
     def unexecute(self):
-        self.target.add_edge(self.params.name1, self.params.name2)
+        self.target.add_edge(self.name1, self.name2)
+        self.target.get_edge(self.name1, self.name2).options.update(
+            self.options)
+
+    def get_size(self):
+        return UndoableCommand.get_size(self) + sys.getsizeof(self.options)
 
 
 class SetEdgeAttribute(UndoableCommand):
+    __slots__ = ('name1', 'name2', 'key', 'value', 'old')
+
     def __init__(self, target, params):
         self.target = target
-        self.params = params
+        self.name1 = params.name1
+        self.name2 = params.name2
+        self.key = params.key
+        self.value = params.value
+        self.old = None
 
     def execute(self):
+        self.old = self.target.get_edge(
+            self.name1, self.name2).options.get(self.key)
         self.target.set_edge_attribute(
-            self.params.name1,
-            self.params.name2,
-            self.params.key,
-            self.params.value
+            self.name1,
+            self.name2,
+            self.key,
+            self.value
         )
 
     def unexecute(self):
-        self.target.remove_edge_attribute(
-            self.params.name1,
-            self.params.name2,
-            self.params.key
-        )
+        if self.old is None:
+            self.target.remove_edge_attribute(
+                self.name1, self.name2, self.key)
+        else:
+            self.target.set_edge_attribute(
+                self.name1, self.name2, self.key, self.old)
+
+    def merge(self, command):
+        if type(command) is not SetEdgeAttribute or command.key != self.key:
+            return False
+        if Edge.get_edge_name(command.name1, command.name2) != \
+                Edge.get_edge_name(self.name1, self.name2):
+            return False
+        self.value = command.value
+        return True
+
+
+# commands grouped by begin/commit: one history step, undone in reverse
+class MacroCommand(UndoableCommand):
+    __slots__ = ('commands',)
+
+    def __init__(self, target, *args):
+        self.target = target
+        self.commands = []
+
+    def add(self, command):
+        if not self.commands or not self.commands[-1].merge(command):
+            self.commands.append(command)
+
+    def execute(self):
+        for command in self.commands:
+            command.execute()
+
+    def unexecute(self):
+        for command in reversed(self.commands):
+            command.unexecute()
+
+    def get_size(self):
+        return sys.getsizeof(self) + sys.getsizeof(self.commands) + sum(
+            command.get_size() for command in self.commands)
 
 
 class PrintGraph(Command):
@@ -243,20 +398,96 @@ class PrintGraph(Command):
         sys.stdout.write(printable_graph)
 
 
+def get_number(text, minimum):
+    if not str(text).isdigit() or int(text) < minimum:
+        raise ValueError('%s is not a number from %d up' % (text, minimum))
+    return int(text)
+
+
 class Undo(Command):
-    def __init__(self, target, *args):
+    def __init__(self, target, params):
         self.target = target
+        self.count = get_number(params.count, 1)
 
     def execute(self):
-        self.target.history.do_undo()
+        self.target.history.do_undo(self.count)
 
 
 class Redo(Command):
+    def __init__(self, target, params):
+        self.target = target
+        self.count = get_number(params.count, 1)
+
+    def execute(self):
+        self.target.history.do_redo(self.count)
+
+
+class Goto(Command):
+    def __init__(self, target, params):
+        self.target = target
+        self.revision = get_number(params.revision, 0)
+
+    def execute(self):
+        self.target.history.goto(self.revision)
+
+
+class ShowRevision(Command):
+    def __init__(self, target, *args):
+        self.target = target
+
+    def execute(self):
+        (oldest, current, newest) = self.target.history.get_revisions()
+        print 'revision %d, history has %d to %d' % (current, oldest, newest)
+
+
+class ShowStats(Command):
+    def __init__(self, target, params):
+        self.target = target
+        self.json = params.json
+
+    def execute(self):
+        stats = self.target.stats
+        if stats is None:
+            raise AttributeError('Statistics are off, start with --stats')
+        if self.json:
+            with open(self.json, 'w') as stream:
+                json.dump(stats.to_dict(self.target.history), stream,
+                          indent=1, sort_keys=True)
+        else:
+            stats.write_report(sys.stdout, self.target.history)
+
+
+class Begin(Command):
+    def __init__(self, target, *args):
+        self.target = target
+
+    def execute(self):
+        self.target.history.begin(MacroCommand(self.target))
+
+
+class Commit(Command):
+    def __init__(self, target, *args):
+        self.target = target
+
+    def execute(self):
+        self.target.history.commit()
+
+
+class Rollback(Command):
     def __init__(self, target, *args):
         self.target = target
 
     def execute(self):
-        self.target.history.do_redo()
+        self.target.history.rollback()
+
+
+# argparse has printed the help already
+class Help(Command):
+    def __init__(self, *args):
+        pass
+
+    def execute(self):
+        pass
 
 
 class Exit(Command):
@@ -268,90 +499,640 @@ class Exit(Command):
         sys.exit(0)
 
 
+# on-disk stack of pickled history entries; the top of the stack is the end of
+# the file, so loading an entry back just truncates the file
+class SpillFile(object):
+    def __init__(self, path, target=None):
+        self.file = open(path, 'w+b')
+        self.target = target
+        self.offsets = []
+        self.end = 0
+
+    def __len__(self):
+        return len(self.offsets)
+
+# references to the edited object are stored as a token, not pickled
+    def persistent_id(self, obj):
+        return 'target' if obj is self.target else None
+
+    def persistent_load(self, pid):
+        return self.target
+
+    def push(self, entry):
+        self.file.seek(self.end)
+        pickler = cPickle.Pickler(self.file, cPickle.HIGHEST_PROTOCOL)
+        pickler.persistent_id = self.persistent_id
+        pickler.dump(entry)
+        self.offsets.append(self.end)
+        self.end = self.file.tell()
+
+    def pop(self):
+        offset = self.offsets.pop()
+        self.file.seek(offset)
+        unpickler = cPickle.Unpickler(self.file)
+        unpickler.persistent_load = self.persistent_load
+        entry = unpickler.load()
+        self.file.truncate(offset)
+        self.end = offset
+        return entry
+
+    def clear(self):
+        self.file.truncate(0)
+        self.offsets = []
+        self.end = 0
+
+
+# commands with their inverses; with checkpoint_entries or checkpoint_bytes
+# set, the graph state is also saved every that many edits (or bytes of
+# them), and goto starts from the nearest checkpoint instead of undoing or
+# redoing all the way
 class History(object):
-    def __init__(self):
-        self.undo = []
-        self.redo = []
-
-    def do_undo(self):
-        if not self.undo:
+    def __init__(self, max_entries=None, max_bytes=None, spill_file=None,
+                 target=None, checkpoint_entries=None, checkpoint_bytes=None,
+                 max_checkpoints=MAX_CHECKPOINTS):
+        self.undo = collections.deque()
+        self.redo = collections.deque()
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+# estimated bytes held by entries kept in memory
+        self.size = 0
+        self.track_size = max_bytes is not None or (
+            checkpoint_bytes is not None)
+        self.undo_spill = None
+        self.redo_spill = None
+        if spill_file:
+            self.undo_spill = SpillFile(spill_file, target)
+            self.redo_spill = SpillFile(spill_file + '.redo', target)
+# MacroCommand collecting commands between begin and commit
+        self.transaction = None
+        self.target = target
+# edits minus undone ones since the start
+        self.revision = 0
+# revision -> Graph.get_state() at that revision
+        self.checkpoints = {}
+# bytes of the pickled checkpoints, counted against max_bytes as well
+        self.checkpoint_size = 0
+        self.checkpoint_entries = checkpoint_entries
+        self.checkpoint_bytes = checkpoint_bytes
+        self.max_checkpoints = max_checkpoints
+# edits since the last checkpoint
+        self.unsaved_entries = 0
+        self.unsaved_bytes = 0
+
+    def check_transaction(self):
+        if self.transaction is not None:
+            raise IndexError('Commit or roll back the transaction first')
+
+    def do_undo(self, count=1):
+        self.check_transaction()
+        available = self.get_undo_count()
+        if not available:
             raise IndexError('Nothing to undo')
-        command = self.undo.pop()
+        if count > available:
+            raise IndexError('Only %d steps to undo' % available)
+        self.goto(self.revision - count)
+
+    def do_redo(self, count=1):
+        self.check_transaction()
+        available = self.get_redo_count()
+        if not available:
+            raise IndexError('Nothing to redo')
+        if count > available:
+            raise IndexError('Only %d steps to redo' % available)
+        self.goto(self.revision + count)
+
+    def step_back(self):
+        command = self.pop(self.undo, self.undo_spill)
         command.unexecute()
-        self.redo.append(command)
+        self.push(self.redo, command)
+        self.revision -= 1
 
-    def do_redo(self):
-        if not self.redo:
-            raise IndexError('Nothing to redo')
-        command = self.redo.pop()
+    def step_forward(self):
+        command = self.pop(self.redo, self.redo_spill)
         command.execute()
-        self.undo.append(command)
+        self.push(self.undo, command)
+        self.revision += 1
+
+# restoring a checkpoint costs a copy of the graph, and then at most
+# checkpoint_entries steps; it is used when that is fewer steps than going
+# from the current revision
+    def goto(self, revision):
+        self.check_transaction()
+        (oldest, current, newest) = self.get_revisions()
+        if not oldest <= revision <= newest:
+            raise IndexError('No revision %d, history has %d to %d' % (
+                revision, oldest, newest))
+        start = None
+        for checkpoint in self.checkpoints:
+            if oldest <= checkpoint <= revision and (
+                    start is None or checkpoint > start):
+                start = checkpoint
+        if start is not None and revision - start < abs(revision - current):
+            self.target.set_state(self.checkpoints[start])
+# the checkpoint already has the commands in between done or undone
+            if self.revision > start:
+                self.move(self.undo, self.undo_spill, self.redo,
+                          self.revision - start)
+            else:
+                self.move(self.redo, self.redo_spill, self.undo,
+                          start - self.revision)
+            self.revision = start
+        while self.revision > revision:
+            self.step_back()
+        while self.revision < revision:
+            self.step_forward()
+
+# top entries of one stack onto the other, without running them
+    def move(self, stack, spill, destination, count):
+        for i in xrange(count):
+            if stack:
+                destination.append(stack.pop())
+            else:
+                entry = spill.pop()
+                size = 0
+                if self.track_size:
+                    size = self.get_entry_size(entry)
+                destination.append((entry, size))
+                self.size += size
+        self.trim()
 
     def add(self, command):
-        self.undo.append(command)
+# a transaction reaches the history as one command on commit; until then
+# a rollback leaves the redo stack as it was
+        if self.transaction is not None:
+            self.transaction.add(command)
+            return
 # flush redo stack, if action called from command line
-        del self.redo[:]
+        if self.redo:
+            self.size -= sum(size for (entry, size) in self.redo)
+            self.redo.clear()
+        if self.redo_spill is not None:
+            self.redo_spill.clear()
+        for revision in [r for r in self.checkpoints if r > self.revision]:
+            self.drop_checkpoint(revision)
+        size = self.push(self.undo, command)
+        self.revision += 1
+        self.count_change(size)
+
+    def count_change(self, size):
+        self.unsaved_entries += 1
+        self.unsaved_bytes += size
+        if self.checkpoint_entries is not None and (
+                self.unsaved_entries >= self.checkpoint_entries):
+            self.add_checkpoint()
+        elif self.checkpoint_bytes is not None and (
+                self.unsaved_bytes >= self.checkpoint_bytes):
+            self.add_checkpoint()
+
+    def add_checkpoint(self):
+# checkpoints before the oldest kept command can't be replayed from
+        oldest = self.revision - self.get_undo_count()
+        for revision in [r for r in self.checkpoints if r < oldest]:
+            self.drop_checkpoint(revision)
+        state = self.target.get_state()
+        self.checkpoints[self.revision] = state
+        self.checkpoint_size += len(state)
+        if len(self.checkpoints) > self.max_checkpoints:
+            self.drop_checkpoint(min(self.checkpoints))
+        self.unsaved_entries = 0
+        self.unsaved_bytes = 0
+        self.trim()
+
+    def drop_checkpoint(self, revision):
+        self.checkpoint_size -= len(self.checkpoints.pop(revision))
+
+    def get_undo_count(self):
+        if self.undo_spill is None:
+            return len(self.undo)
+        return len(self.undo) + len(self.undo_spill)
+
+    def get_redo_count(self):
+        if self.redo_spill is None:
+            return len(self.redo)
+        return len(self.redo) + len(self.redo_spill)
+
+# (oldest, current, newest) revision
+    def get_revisions(self):
+        return (self.revision - self.get_undo_count(), self.revision,
+                self.revision + self.get_redo_count())
+
+    def begin(self, macro):
+        if self.transaction is not None:
+            raise IndexError('Transaction already started')
+        self.transaction = macro
+
+    def commit(self):
+        macro = self.end_transaction()
+        if macro.commands:
+            self.add(macro)
+
+    def rollback(self):
+        self.end_transaction().unexecute()
+
+    def end_transaction(self):
+        if self.transaction is None:
+            raise IndexError('No transaction started')
+        macro = self.transaction
+        self.transaction = None
+        return macro
+
+    def push(self, stack, entry):
+        size = 0
+        if self.track_size:
+            size = self.get_entry_size(entry)
+        stack.append((entry, size))
+        self.size += size
+        self.trim()
+        return size
+
+    def pop(self, stack, spill):
+        if stack:
+            (entry, size) = stack.pop()
+            self.size -= size
+            return entry
+        if spill is not None:
+            return spill.pop()
+        return None
+
+# keep memory within budget: checkpoints only save time, so the oldest of
+# them go first; then the oldest undo entries and the farthest redo entries
+# go to the spill files, or are dropped if spilling is off; the entry limit
+# holds for each stack, the byte budget is taken from the longer one
+    def trim(self):
+        while self.checkpoints and self.over_bytes():
+            self.drop_checkpoint(min(self.checkpoints))
+        stacks = ((self.undo, self.undo_spill), (self.redo, self.redo_spill))
+        if self.max_entries is not None:
+            for (stack, spill) in stacks:
+                while len(stack) > self.max_entries:
+                    self.evict(stack, spill)
+        while (self.undo or self.redo) and self.over_bytes():
+            (stack, spill) = max(stacks, key=lambda pair: len(pair[0]))
+            self.evict(stack, spill)
+
+    def evict(self, stack, spill):
+        (entry, size) = stack.popleft()
+        self.size -= size
+        if spill is not None:
+            spill.push(entry)
+
+    def over_bytes(self):
+        return self.max_bytes is not None and (
+            self.size + self.checkpoint_size > self.max_bytes)
+
+    def get_entry_size(self, command):
+        return command.get_size()
+
+    def get_stats(self):
+        spilled = 0
+        for spill in (self.undo_spill, self.redo_spill):
+            if spill is not None:
+                spilled += len(spill)
+# sizes are only tracked with a byte budget
+        size = self.size
+        if not self.track_size:
+            size = sum(entry.get_size()
+                       for stack in (self.undo, self.redo)
+                       for (entry, _) in stack)
+        return {
+            'undo_entries': len(self.undo),
+            'redo_entries': len(self.redo),
+            'bytes': size,
+            'spilled_entries': spilled,
+            'revision': self.revision,
+            'checkpoints': len(self.checkpoints),
+            'checkpoint_bytes': self.checkpoint_size,
+        }
+
+
+# latency histogram: bucket i counts calls that took less than 2**i
+# microseconds, the last one also everything slower
+STATS_BUCKETS = 32
+
+
+class Timer(object):
+    __slots__ = ('count', 'seconds', 'objects', 'buckets')
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.objects = 0
+        self.buckets = [0] * STATS_BUCKETS
+
+    def add(self, seconds, objects):
+        self.count += 1
+        self.seconds += seconds
+        self.objects += objects
+        bucket = int(seconds * 1000000).bit_length()
+        self.buckets[min(bucket, STATS_BUCKETS - 1)] += 1
+
+# upper bound, in microseconds, of the bucket the given share of calls fits in
+    def get_percentile(self, share):
+        seen = 0
+        for (i, count) in enumerate(self.buckets):
+            seen += count
+            if seen >= share * self.count:
+                return 2 ** i
+        return 2 ** (STATS_BUCKETS - 1)
+
+    def to_dict(self):
+        return {
+            'count': self.count,
+            'seconds': self.seconds,
+            'objects': self.objects,
+            'histogram': dict((str(2 ** i), count)
+                              for (i, count) in enumerate(self.buckets)
+                              if count),
+        }
+
+
+# opt-in timing of chosen functions: nothing is wrapped, so nothing costs,
+# until they are handed to wrap() or instrument(); times are inclusive of
+# the instrumented calls made inside
+class Stats(object):
+    def __init__(self):
+        self.timers = {}
+
+    def wrap(self, name, function):
+        timer = self.timers.setdefault(name, Timer())
+
+# the GC counts container objects created minus those freed, and resets
+# the count on every collection, so collections wait until the call is over;
+# the result is net growth, which is negative for calls that free objects
+        def timed(*args, **kwargs):
+            enabled = gc.isenabled()
+            gc.disable()
+            objects = gc.get_count()[0]
+            started = time.time()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                timer.add(time.time() - started,
+                          gc.get_count()[0] - objects)
+                if enabled:
+                    gc.enable()
+        timed.__name__ = function.__name__
+        return timed
+
+# wraps the methods of one object, so that other graphs are left alone
+    def instrument(self, obj, prefix, names):
+        for name in names:
+            setattr(obj, name, self.wrap(prefix + name, getattr(obj, name)))
+
+    def to_dict(self, history):
+        return {
+            'timers': dict((name, timer.to_dict())
+                           for (name, timer) in self.timers.iteritems()
+                           if timer.count),
+            'history': history.get_stats(),
+        }
+
+    def write_report(self, stream, history):
+        stream.write('%-32s %8s %10s %9s %8s %8s %9s\n' % (
+            'name', 'calls', 'total ms', 'mean us', 'p50 us', 'p99 us',
+            'objects'))
+        timers = sorted(self.timers.iteritems(),
+                        key=lambda item: -item[1].seconds)
+        for (name, timer) in timers:
+            if not timer.count:
+                continue
+            stream.write('%-32s %8d %10.1f %9.1f %8d %8d %9d\n' % (
+                name, timer.count, timer.seconds * 1000,
+                timer.seconds * 1000000 / timer.count,
+                timer.get_percentile(0.5), timer.get_percentile(0.99),
+                timer.objects))
+        items = sorted(history.get_stats().iteritems())
+        stream.write('history: %s\n' % ', '.join(
+            '%s %s' % (key, value) for (key, value) in items))
+
+
+# subcommands as (name, help, arguments, Command class); every argument is
+# a name (a flag for options) with add_argument keyword arguments
+COMMANDS = (
+    ('add_vertex', 'vertex adding', [('name', {})], AddVertex),
+    ('remove_vertex', 'vertex deleting', [('name', {})], RemoveVertex),
+    ('set_vertex_attribute', 'setting vertex attribute',
+     [('name', {}), ('key', {}), ('value', {})], SetVertexAttribute),
+    ('add_edge', 'edge adding', [('name1', {}), ('name2', {})], AddEdge),
+    ('remove_edge', 'edge deleting', [('name1', {}), ('name2', {})],
+     RemoveEdge),
+    ('set_edge_attribute', 'setting edge attribute',
+     [('name1', {}), ('name2', {}), ('key', {}), ('value', {})],
+     SetEdgeAttribute),
+    ('begin', 'start grouping actions into one undo step', [], Begin),
+    ('commit', 'finish the group started by begin', [], Commit),
+    ('rollback', 'undo and drop the group started by begin', [], Rollback),
+    ('undo', 'undo the last action (or N of them)', [
+        ('count', {'nargs': '?', 'default': '1', 'metavar': 'N'}),
+    ], Undo),
+    ('redo', 'redo the last action (or N of them)', [
+        ('count', {'nargs': '?', 'default': '1', 'metavar': 'N'}),
+    ], Redo),
+    ('goto', 'undo or redo up to a revision', [('revision', {})], Goto),
+    ('revision', 'current and available revisions', [], ShowRevision),
+    ('print', 'graph printing', [], PrintGraph),
+    ('stats', 'command, graph and history statistics (--stats)', [
+        ('--json', {'metavar': 'FILE', 'help': 'write them to FILE as JSON'}),
+    ], ShowStats),
+    ('exit', 'exits the editor', [], Exit),
+)
+COMMAND_NAMES = dict(
+    (command, name) for (name, help_text, arguments, command) in COMMANDS)
 
 
 def get_parser():
     parser = argparse.ArgumentParser()
     subparsers = parser.add_subparsers(title="Commands", metavar="<command>")
+    for (name, help_text, arguments, command) in COMMANDS:
+        subparser = subparsers.add_parser(name, help=help_text)
+        for (argument, options) in arguments:
+            subparser.add_argument(argument, **options)
+        subparser.set_defaults(command=command)
+    return parser
 
-    p_va = subparsers.add_parser('add_vertex', help='vertex adding')
-    p_va.add_argument('name')
-    p_va.set_defaults(command=AddVertex)
-
-    p_rv = subparsers.add_parser('remove_vertex', help='vertex deleting')
-    p_rv.add_argument('name')
-    p_rv.set_defaults(command=RemoveVertex)
-
-    p_sva = subparsers.add_parser(
-        'set_vertex_attribute', help='setting vertex attribute')
-    p_sva.add_argument('name')
-    p_sva.add_argument('key')
-    p_sva.add_argument('value')
-    p_sva.set_defaults(command=SetVertexAttribute)
-
-    p_ae = subparsers.add_parser('add_edge', help='edge adding')
-    p_ae.add_argument('name1')
-    p_ae.add_argument('name2')
-    p_ae.set_defaults(command=AddEdge)
-
-    p_re = subparsers.add_parser('remove_edge', help='edge deleting')
-    p_re.add_argument('name1')
-    p_re.add_argument('name2')
-    p_re.set_defaults(command=RemoveEdge)
-
-    p_sea = subparsers.add_parser(
-        'set_edge_attribute', help='setting edge attribute')
-    p_sea.add_argument('name1')
-    p_sea.add_argument('name2')
-    p_sea.add_argument('key')
-    p_sea.add_argument('value')
-    p_sea.set_defaults(command=SetEdgeAttribute)
-
-    p_undo = subparsers.add_parser('undo', help='undo the last action')
-    p_undo.set_defaults(command=Undo)
-
-    p_redo = subparsers.add_parser('redo', help='redo the last action')
-    p_redo.set_defaults(command=Redo)
-
-    p_pg = subparsers.add_parser('print', help='graph printing')
-    p_pg.set_defaults(command=PrintGraph)
-
-    p_exit = subparsers.add_parser('exit', help='exits the editor')
-    p_exit.set_defaults(command=Exit)
+
+# command name -> (positional fields with their choices, defaults), made
+# straight from COMMANDS; the argparse parser, only needed for lines with
+# options or asking for help, is built on first use
+class CommandTable(dict):
+    def __init__(self, get_parser):
+        dict.__init__(self)
+        self.get_parser = get_parser
+        self.parser = None
+
+    def parse_args(self, words):
+        if self.parser is None:
+            self.parser = self.get_parser()
+        return self.parser.parse_args(words)
+
+
+# also counts the positional fields that can't be left out
+def get_table_entry(arguments, defaults):
+    fields = []
+    required = 0
+    for (argument, options) in arguments:
+        if argument.startswith('-'):
+            default = options.get('default')
+            if default is None and options.get('action') == 'store_true':
+                default = False
+            defaults[argument.lstrip('-').replace('-', '_')] = default
+        else:
+            fields.append((argument, options.get('choices')))
+            if options.get('nargs') == '?':
+                defaults[argument] = options.get('default')
+            else:
+                required += 1
+    return (fields, defaults, required)
+
+
+def get_command_table():
+    table = CommandTable(get_parser)
+    for (name, help_text, arguments, command) in COMMANDS:
+        table[name] = get_table_entry(arguments, {'command': command})
+    return table
+
+
+def parse_command(table, words):
+    entry = table.get(words[0])
+    if entry is None and not words[0].startswith('-'):
+        raise ValueError('Unknown command %s' % words[0])
+    if entry is not None and not any(
+            word.startswith('-') for word in words[1:]):
+        (fields, defaults, required) = entry
+        if not required <= len(words) - 1 <= len(fields):
+            if required == len(fields):
+                raise ValueError(
+                    '%s takes %d arguments' % (words[0], len(fields)))
+            raise ValueError('%s takes %d to %d arguments' % (
+                words[0], required, len(fields)))
+        args = argparse.Namespace(**defaults)
+        for ((field, choices), word) in zip(fields, words[1:]):
+            if choices is not None and word not in choices:
+                raise ValueError(
+                    '%s must be one of %s' % (field, ', '.join(choices)))
+            setattr(args, field, word)
+        return args
+# options and help go through argparse
+    try:
+        return table.parse_args(words)
+    except SystemExit, e:
+        if e.code:
+            raise ValueError('Bad arguments for %s' % words[0])
+    return argparse.Namespace(command=Help)
+
+
+def run_command(graph, args):
+    command = args.command(graph, args)
+    if graph.stats is None:
+        command.execute()
+    else:
+        graph.stats.wrap(
+            'command.' + COMMAND_NAMES.get(args.command, 'help'),
+            command.execute)()
+    if issubclass(args.command, UndoableCommand):
+        graph.history.add(command)
+
+
+GRAPH_STATS_METHODS = (
+    'add_vertex', 'remove_vertex', 'set_vertex_attribute',
+    'remove_vertex_attribute', 'add_edge', 'remove_edge',
+    'set_edge_attribute', 'remove_edge_attribute',
+)
+HISTORY_STATS_METHODS = ('add', 'do_undo', 'do_redo', 'trim')
+
+
+# times every command run (redone ones count under history.do_redo), the
+# mutations and History operations of one graph; command classes are shared
+# by all graphs, so run_command times them instead of wrapping them here
+def enable_stats(graph):
+    if graph.stats is not None:
+        return
+    stats = Stats()
+    stats.instrument(graph, 'graph.', GRAPH_STATS_METHODS)
+    stats.instrument(graph.history, 'history.', HISTORY_STATS_METHODS)
+    graph.stats = stats
+
+
+def run_script(graph, stream, table):
+    count = 0
+    errors = 0
+# bulk runs allocate lots of long-living objects and no garbage cycles
+    gc.disable()
+    started = time.time()
+    try:
+        for (line_no, line) in enumerate(stream, 1):
+            words = line.split()
+            if not words or words[0].startswith('#'):
+                continue
+            count += 1
+            try:
+                run_command(graph, parse_command(table, words))
+            except Exception, e:
+                errors += 1
+                sys.stderr.write('line %d: %s\n' % (line_no, e))
+    finally:
+        gc.enable()
+    elapsed = time.time() - started
+    sys.stderr.write('%d commands in %.3f s (%d/s), %d errors\n' % (
+        count, elapsed, count / elapsed if elapsed else 0, errors))
+    return errors
+
+
+def get_cli_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--history-entries', type=int, metavar='N',
+        help='undo steps kept in memory')
+    parser.add_argument(
+        '--history-bytes', type=int, metavar='N',
+        help='memory budget for undo steps')
+    parser.add_argument(
+        '--history-spill', metavar='FILE',
+        help='spill old undo steps to FILE instead of dropping them')
+    parser.add_argument(
+        '--checkpoint-entries', type=int, metavar='N',
+        help='save the graph for goto, undo N and redo N every N edits')
+    parser.add_argument(
+        '--checkpoint-bytes', type=int, metavar='N',
+        help='save the graph every N bytes of undo steps')
+    parser.add_argument(
+        '--checkpoints', type=int, default=MAX_CHECKPOINTS, metavar='N',
+        help='saved graphs kept')
+    parser.add_argument(
+        '--stats', action='store_true',
+        help="time commands and graph operations (see 'stats')")
+    parser.add_argument(
+        '--script', metavar='FILE',
+        help="run commands from FILE ('-' for stdin) without the prompt")
     return parser
 
+
+def get_history_options(options):
+    return {
+        'max_entries': options.history_entries,
+        'max_bytes': options.history_bytes,
+        'spill_file': options.history_spill,
+        'checkpoint_entries': options.checkpoint_entries,
+        'checkpoint_bytes': options.checkpoint_bytes,
+        'max_checkpoints': options.checkpoints,
+    }
+
 if __name__ == '__main__':
-    mygraph = Graph('mygraph')
-    parser = get_parser()
+    options = get_cli_parser().parse_args()
+    mygraph = Graph('mygraph', **get_history_options(options))
+    table = get_command_table()
+    if options.stats:
+        enable_stats(mygraph)
+    if options.script or not sys.stdin.isatty():
+        stream = sys.stdin
+        if options.script not in (None, '-'):
+            stream = open(options.script)
+        errors = run_script(mygraph, stream, table)
+        sys.exit(1 if errors else 0)
     while True:
         try:
-            args = parser.parse_args(raw_input('\n>>> Enter action: ').split())
-            command = args.command(mygraph, args)
-            command.execute()
-            if issubclass(args.command, UndoableCommand):
-                mygraph.history.add(command)
+            words = raw_input('\n>>> Enter action: ').split()
+            if words:
+                run_command(mygraph, parse_command(table, words))
         except Exception, e:
             print e
@@ -2,7 +2,260 @@
 import sys
 import re
 import argparse
+import collections
+import cPickle
+import cStringIO
+import gc
+import json
+import os
+import struct
+import time
 import copy
+import math
+import weakref
+
+
+# persistent (immutable) hash array mapped trie: every update returns a new
+# map that shares all untouched nodes with the old one, so keeping an old
+# version around costs nothing and an update copies O(log n) nodes
+HAMT_BITS = 5
+HAMT_MASK = (1 << HAMT_BITS) - 1
+HASH_BITS = 32
+# rough size of a half-filled trie node, for history memory accounting
+TRIE_NODE_SIZE = 64 + 8 * (1 << HAMT_BITS) / 2
+
+
+def popcount(x):
+    return bin(x).count('1')
+
+
+def key_hash(key):
+    return hash(key) & 0xFFFFFFFF
+
+
+# nodes are weakly referenced by the spill file that has written them
+class BitmapNode(object):
+    __slots__ = ('bitmap', 'array', '__weakref__')
+
+    def __init__(self, bitmap, array):
+        self.bitmap = bitmap
+# entries are (key, value) leaves or child nodes, ordered by bit position
+        self.array = array
+
+    def get(self, shift, h, key, default):
+        bit = 1 << ((h >> shift) & HAMT_MASK)
+        if not self.bitmap & bit:
+            return default
+        entry = self.array[popcount(self.bitmap & (bit - 1))]
+        if type(entry) is tuple:
+            return entry[1] if entry[0] == key else default
+        return entry.get(shift + HAMT_BITS, h, key, default)
+
+    def assoc(self, shift, h, key, value):
+        bit = 1 << ((h >> shift) & HAMT_MASK)
+        idx = popcount(self.bitmap & (bit - 1))
+        array = self.array
+        if not self.bitmap & bit:
+            array = array[:idx] + ((key, value),) + array[idx:]
+            return BitmapNode(self.bitmap | bit, array), True
+        entry = array[idx]
+        if type(entry) is tuple:
+            if entry[0] == key:
+                if entry[1] is value:
+                    return self, False
+                new_entry, added = (key, value), False
+            else:
+                new_entry = merge_leaves(
+                    shift + HAMT_BITS, key_hash(entry[0]), entry,
+                    h, (key, value))
+                added = True
+        else:
+            new_entry, added = entry.assoc(shift + HAMT_BITS, h, key, value)
+            if new_entry is entry:
+                return self, False
+        return BitmapNode(
+            self.bitmap, array[:idx] + (new_entry,) + array[idx + 1:]), added
+
+# returns a node, a single leaf to be inlined by the parent, or None
+    def without(self, shift, h, key):
+        bit = 1 << ((h >> shift) & HAMT_MASK)
+        if not self.bitmap & bit:
+            raise KeyError(key)
+        idx = popcount(self.bitmap & (bit - 1))
+        array = self.array
+        entry = array[idx]
+        if type(entry) is tuple:
+            if entry[0] != key:
+                raise KeyError(key)
+            new_entry = None
+        else:
+            new_entry = entry.without(shift + HAMT_BITS, h, key)
+        if new_entry is None:
+            if len(array) == 1:
+                return None
+            array = array[:idx] + array[idx + 1:]
+            if len(array) == 1 and type(array[0]) is tuple and shift:
+                return array[0]
+            return BitmapNode(self.bitmap ^ bit, array)
+        if type(new_entry) is tuple and len(array) == 1 and shift:
+            return new_entry
+        return BitmapNode(
+            self.bitmap, array[:idx] + (new_entry,) + array[idx + 1:])
+
+    def iteritems(self):
+        for entry in self.array:
+            if type(entry) is tuple:
+                yield entry
+            else:
+                for item in entry.iteritems():
+                    yield item
+
+
+class CollisionNode(object):
+    __slots__ = ('array', '__weakref__')
+
+    def __init__(self, array):
+        self.array = array
+
+    def get(self, shift, h, key, default):
+        for k, v in self.array:
+            if k == key:
+                return v
+        return default
+
+    def assoc(self, shift, h, key, value):
+        for idx, (k, v) in enumerate(self.array):
+            if k == key:
+                if v is value:
+                    return self, False
+                array = self.array[:idx] + ((key, value),) + \
+                    self.array[idx + 1:]
+                return CollisionNode(array), False
+        return CollisionNode(self.array + ((key, value),)), True
+
+    def without(self, shift, h, key):
+        for idx, (k, v) in enumerate(self.array):
+            if k == key:
+                array = self.array[:idx] + self.array[idx + 1:]
+                return array[0] if len(array) == 1 else CollisionNode(array)
+        raise KeyError(key)
+
+    def iteritems(self):
+        return iter(self.array)
+
+
+def iter_entry(entry):
+    if entry is None:
+        return ()
+    if type(entry) is tuple:
+        return (entry,)
+    return entry.iteritems()
+
+
+# yields (key, value, other value) for every key whose values differ, None
+# standing for a missing key; subtrees both tries share are skipped, so the
+# cost follows the number of differences, not the size of the maps
+def diff_entries(shift, a, b):
+    if a is b:
+        return
+    if type(a) is BitmapNode and type(b) is BitmapNode:
+        bitmap = a.bitmap | b.bitmap
+        while bitmap:
+            bit = bitmap & -bitmap
+            bitmap ^= bit
+            entry_a = entry_b = None
+            if a.bitmap & bit:
+                entry_a = a.array[popcount(a.bitmap & (bit - 1))]
+            if b.bitmap & bit:
+                entry_b = b.array[popcount(b.bitmap & (bit - 1))]
+            for item in diff_entries(shift + HAMT_BITS, entry_a, entry_b):
+                yield item
+        return
+# leaves, collisions or a leaf against a subtree: the subtree holds keys
+# that the leaf side lacks, so comparing items stays within the change
+    new = dict(iter_entry(b))
+    for (key, value) in iter_entry(a):
+        other = new.pop(key, None)
+        if other is not value:
+            yield (key, value, other)
+    for (key, value) in new.iteritems():
+        yield (key, None, value)
+
+
+def merge_leaves(shift, h1, leaf1, h2, leaf2):
+    if shift >= HASH_BITS:
+        return CollisionNode((leaf1, leaf2))
+    bit1 = (h1 >> shift) & HAMT_MASK
+    bit2 = (h2 >> shift) & HAMT_MASK
+    if bit1 == bit2:
+        child = merge_leaves(shift + HAMT_BITS, h1, leaf1, h2, leaf2)
+        return BitmapNode(1 << bit1, (child,))
+    array = (leaf1, leaf2) if bit1 < bit2 else (leaf2, leaf1)
+    return BitmapNode((1 << bit1) | (1 << bit2), array)
+
+
+class PersistentMap(object):
+    __slots__ = ('root', 'count')
+
+    def __init__(self, root=None, count=0):
+        self.root = root if root is not None else BitmapNode(0, ())
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, key):
+        return self.get(key, _missing) is not _missing
+
+    def __getitem__(self, key):
+        value = self.get(key, _missing)
+        if value is _missing:
+            raise KeyError(key)
+        return value
+
+    def get(self, key, default=None):
+        return self.root.get(0, key_hash(key), key, default)
+
+    def set(self, key, value):
+        root, added = self.root.assoc(0, key_hash(key), key, value)
+        if root is self.root:
+            return self
+        return PersistentMap(root, self.count + 1 if added else self.count)
+
+    def remove(self, key):
+        root = self.root.without(0, key_hash(key), key)
+        if root is None:
+            return PersistentMap()
+        return PersistentMap(root, self.count - 1)
+
+    def iteritems(self):
+        return self.root.iteritems()
+
+    def diff(self, other):
+        return diff_entries(0, self.root, other.root)
+
+    def iterkeys(self):
+        for k, v in self.root.iteritems():
+            yield k
+
+    def itervalues(self):
+        for k, v in self.root.iteritems():
+            yield v
+
+    __iter__ = iterkeys
+
+    def keys(self):
+        return list(self.iterkeys())
+
+    def values(self):
+        return list(self.itervalues())
+
+    def items(self):
+        return list(self.iteritems())
+
+
+_missing = object()
+EMPTY_MAP = PersistentMap()
 
 
 class Item(object):
@@ -19,6 +272,12 @@ class Item(object):
             raise AttributeError('No option with key %s' % key)
         del self.options[key]
 
+# items stored in a Graph are shared between snapshots: change a copy
+    def copy(self):
+        item = copy.copy(self)
+        item.options = dict(self.options)
+        return item
+
 # generalized function for getting Item options to be printed
     def get_printable_options(self):
         options_str = ''
@@ -59,11 +318,20 @@ class Edge(Item):
         return True if name in [self.name1, self.name2] else False
 
 
+# Graph keeps its state in persistent maps and never mutates an Item that is
+# already stored in them, so snapshot() is a shallow O(1) copy
 class Graph(object):
     def __init__(self, name):
         self.name = name
-        self.vertex_list = {}
-        self.edge_list = {}
+        self.vertex_list = EMPTY_MAP
+        self.edge_list = EMPTY_MAP
+# incidence index: vertex name -> map of neighbor names
+        self.adjacency_list = EMPTY_MAP
+
+    def snapshot(self):
+        state = Graph.__new__(Graph)
+        state.__dict__.update(self.__dict__)
+        return state
 
     def has_vertex(self, name):
         return True if name in self.vertex_list else False
@@ -71,23 +339,42 @@ class Graph(object):
     def add_vertex(self, name):
         if self.has_vertex(name):
             raise AttributeError('Graph has vertex with name %s' % name)
-        self.vertex_list[name] = Vertex(name)
+        self.vertex_list = self.vertex_list.set(name, Vertex(name))
+        self.adjacency_list = self.adjacency_list.set(name, EMPTY_MAP)
 
     def remove_vertex(self, name):
         if not self.has_vertex(name):
             raise AttributeError('No vertex in graph with name %s' % name)
-        del self.vertex_list[name]
-        for key in self.edge_list.keys():
-            if self.edge_list[key].has_vertex(name):
-                del self.edge_list[key]
+        self.vertex_list = self.vertex_list.remove(name)
+        adjacency_list = self.adjacency_list
+        edge_list = self.edge_list
+        for neighbor in adjacency_list[name]:
+            edge_list = edge_list.remove(Edge.get_edge_name(name, neighbor))
+            if neighbor != name:
+                adjacency_list = adjacency_list.set(
+                    neighbor, adjacency_list[neighbor].remove(name))
+        self.adjacency_list = adjacency_list.remove(name)
+        self.edge_list = edge_list
+
+    def get_degree(self, name):
+        if not self.has_vertex(name):
+            raise AttributeError('No vertex in graph with name %s' % name)
+        return len(self.adjacency_list[name])
+
+    def get_neighbors(self, name):
+        if not self.has_vertex(name):
+            raise AttributeError('No vertex in graph with name %s' % name)
+        return self.adjacency_list[name].keys()
 
     def set_vertex_attribute(self, name, key, value):
-        vertex = self.get_vertex(name)
+        vertex = self.get_vertex(name).copy()
         vertex.set_option(key, value)
+        self.vertex_list = self.vertex_list.set(name, vertex)
 
     def remove_vertex_attribute(self, name, key):
-        vertex = self.get_vertex(name)
+        vertex = self.get_vertex(name).copy()
         vertex.remove_option(key)
+        self.vertex_list = self.vertex_list.set(name, vertex)
 
     def has_edge(self, name1, name2):
         if Edge.get_edge_name(name1, name2) in self.edge_list:
@@ -101,12 +388,27 @@ class Graph(object):
             raise AttributeError('No vertex with name %s' % name2)
         if self.has_edge(name1, name2):
             raise AttributeError('Graph has edge %s -- %s' % (name1, name2))
-        self.edge_list[Edge.get_edge_name(name1, name2)] = Edge(name1, name2)
+        self.edge_list = self.edge_list.set(
+            Edge.get_edge_name(name1, name2), Edge(name1, name2))
+        self.link(name1, name2, True)
 
     def remove_edge(self, name1, name2):
         if not self.has_edge(name1, name2):
             raise AttributeError('No edge between %s and %s' % (name1, name2))
-        del self.edge_list[Edge.get_edge_name(name1, name2)]
+        self.edge_list = self.edge_list.remove(
+            Edge.get_edge_name(name1, name2))
+        self.link(name1, name2, False)
+
+    def link(self, name1, name2, linked):
+        adjacency_list = self.adjacency_list
+        for (a, b) in ((name1, name2), (name2, name1)):
+            neighbors = adjacency_list[a]
+            if linked:
+                neighbors = neighbors.set(b, True)
+            elif b in neighbors:
+                neighbors = neighbors.remove(b)
+            adjacency_list = adjacency_list.set(a, neighbors)
+        self.adjacency_list = adjacency_list
 
     def get_vertex(self, name):
         if not self.has_vertex(name):
@@ -119,12 +421,16 @@ class Graph(object):
         return self.edge_list[Edge.get_edge_name(name1, name2)]
 
     def set_edge_attribute(self, name1, name2, key, value):
-        edge = self.get_edge(name1, name2)
+        edge = self.get_edge(name1, name2).copy()
         edge.set_option(key, value)
+        self.edge_list = self.edge_list.set(
+            Edge.get_edge_name(name1, name2), edge)
 
     def remove_edge_attribute(self, name1, name2, key):
-        edge = self.get_edge(name1, name2)
+        edge = self.get_edge(name1, name2).copy()
         edge.remove_option(key)
+        self.edge_list = self.edge_list.set(
+            Edge.get_edge_name(name1, name2), edge)
 
     def get_dot_graph(self):
         buffer = ['graph ', self.name, ' {\n']
@@ -137,6 +443,32 @@ class Graph(object):
         buffer.append('}\n')
         return ''.join(buffer)
 
+# added (+) and removed (-) vertices, edges and options in other; only the
+# trie paths the two states don't share are visited
+    def get_diff(self, other):
+        buffer = []
+        for (name, old, new) in self.vertex_list.diff(other.vertex_list):
+            get_item_diff(buffer, 'vertex ' + name, old, new)
+        for (name, old, new) in self.edge_list.diff(other.edge_list):
+            item = new if old is None else old
+            get_item_diff(
+                buffer, 'edge %s -- %s' % (item.name1, item.name2), old, new)
+        return ''.join(buffer)
+
+
+def get_item_diff(buffer, title, old, new):
+    if old is None:
+        buffer.extend(['+ ', title, new.get_printable_options(), '\n'])
+    elif new is None:
+        buffer.extend(['- ', title, old.get_printable_options(), '\n'])
+    else:
+        for (k, v) in old.options.iteritems():
+            if new.options.get(k) != v:
+                buffer.extend(['- ', title, ': ', k, '=', v, '\n'])
+        for (k, v) in new.options.iteritems():
+            if old.options.get(k) != v:
+                buffer.extend(['+ ', title, ': ', k, '=', v, '\n'])
+
 
 class Activity(object):
     def __init__(self, do, undo, params):
@@ -145,35 +477,407 @@ class Activity(object):
         self.params = params
 
 
+# length of a spill file record
+SPILL_RECORD = struct.Struct('<I')
+
+
+# a record of the spill file, as compact() sees it: nothing is loaded
+class SpillRef(object):
+    __slots__ = ('pid',)
+
+    def __init__(self, pid):
+        self.pid = pid
+
+
+# graph states on disk as trie nodes, every node written once, in a record
+# of its own that its parents refer to by offset; spilling a state writes
+# only the nodes no earlier state has written, and loading one back reuses
+# the nodes still in memory, so both cost about as much as the changes since
+# the states around it; records left only to dropped states are reclaimed by
+# compact()
+class SpillFile(object):
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'w+b')
+        self.end = 0
+# node -> offset of its record and back, for the nodes alive in memory
+        self.offsets = weakref.WeakKeyDictionary()
+        self.nodes = weakref.WeakValueDictionary()
+
+    def write_record(self, data, persistent_id):
+        stream = cStringIO.StringIO()
+        pickler = cPickle.Pickler(stream, cPickle.HIGHEST_PROTOCOL)
+        pickler.persistent_id = persistent_id
+# records referred to are written while the data is pickled
+        pickler.dump(data)
+        data = stream.getvalue()
+        offset = self.end
+        self.file.seek(offset)
+        self.file.write(SPILL_RECORD.pack(len(data)))
+        self.file.write(data)
+        self.end += SPILL_RECORD.size + len(data)
+        return offset
+
+# read whole before unpickling: loading the records referred to moves the
+# file position
+    def read_record(self, offset, persistent_load):
+        self.file.seek(offset)
+        (length,) = SPILL_RECORD.unpack(self.file.read(SPILL_RECORD.size))
+        unpickler = cPickle.Unpickler(
+            cStringIO.StringIO(self.file.read(length)))
+        unpickler.persistent_load = persistent_load
+        return unpickler.load()
+
+    def persistent_id(self, obj):
+        if type(obj) is PersistentMap:
+            return ('map', self.write_node(obj.root), obj.count)
+        if type(obj) is BitmapNode or type(obj) is CollisionNode:
+            return ('node', self.write_node(obj))
+        return None
+
+    def persistent_load(self, pid):
+        if pid[0] == 'map':
+            return PersistentMap(self.read_node(pid[1]), pid[2])
+        return self.read_node(pid[1])
+
+    def write_node(self, node):
+        offset = self.offsets.get(node)
+        if offset is None:
+            bitmap = node.bitmap if type(node) is BitmapNode else None
+            offset = self.write_record(
+                (bitmap, node.array), self.persistent_id)
+            self.offsets[node] = offset
+            self.nodes[offset] = node
+        return offset
+
+    def read_node(self, offset):
+        node = self.nodes.get(offset)
+        if node is None:
+            (bitmap, array) = self.read_record(offset, self.persistent_load)
+            if bitmap is None:
+                node = CollisionNode(array)
+            else:
+                node = BitmapNode(bitmap, array)
+            self.offsets[node] = offset
+            self.nodes[offset] = node
+        return node
+
+    def write_state(self, graph):
+        return self.write_record(graph.__dict__, self.persistent_id)
+
+    def read_state(self, offset):
+        state = Graph.__new__(Graph)
+        state.__dict__.update(self.read_record(offset, self.persistent_load))
+        return state
+
+# copies the records reachable from the given states to a new file, which
+# replaces this one; returns the new offsets by the old ones
+    def compact(self, states):
+        target = SpillFile(self.path + '.tmp')
+        moved = {}
+
+        def move_ref(obj):
+            if type(obj) is SpillRef:
+                return (obj.pid[0], move(obj.pid[1])) + obj.pid[2:]
+            return None
+
+        def move(offset):
+            if offset not in moved:
+                data = self.read_record(offset, SpillRef)
+                moved[offset] = target.write_record(data, move_ref)
+            return moved[offset]
+        for offset in states:
+            move(offset)
+        self.file.close()
+        os.rename(target.path, self.path)
+        self.file = target.file
+        self.end = target.end
+        offsets = weakref.WeakKeyDictionary()
+        nodes = weakref.WeakValueDictionary()
+        for (node, offset) in self.offsets.items():
+            if offset in moved:
+                offsets[node] = moved[offset]
+                nodes[moved[offset]] = node
+        self.offsets = offsets
+        self.nodes = nodes
+        return moved
+
+
+class Revision(object):
+    __slots__ = ('parent', 'state', 'size', 'offset', 'last_child')
+
+    def __init__(self, parent, state, size):
+        self.parent = parent
+        self.state = state
+        self.size = size
+# position in the spill file, once the state has been written there
+        self.offset = None
+# child that redo goes to: the newest one, or the one undo came from
+        self.last_child = None
+
+
+# undo tree: every edit makes a revision, a child of the current one, so
+# editing after undo starts a new branch and keeps the old one; revisions
+# hold graph states, which share all the trie nodes they have in common
 class History(object):
-    def __init__(self):
-        self.undo = []
-        self.redo = []
+    def __init__(self, max_entries=None, max_bytes=None, spill_file=None,
+                 max_spill_bytes=None):
+        self.revisions = {}
+        self.current = None
+        self.next_revision = 0
+# revisions whose states are in memory, oldest first
+        self.loaded = collections.deque()
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+# estimated bytes held by states kept in memory
+        self.size = 0
+        self.spill = None
+        if spill_file:
+            self.spill = SpillFile(spill_file)
+        self.max_spill_bytes = max_spill_bytes
 
-    def do_undo(self, graph):
-        if not self.undo:
+    def do_undo(self):
+        parent = self.revisions[self.current].parent
+        if parent not in self.revisions:
             raise IndexError('Nothing to undo')
-        state = self.undo.pop()
-        self.redo.append(copy.deepcopy(graph))
-        return state
+        self.revisions[parent].last_child = self.current
+        return self.goto(parent)
 
-    def do_redo(self, graph):
-        if not self.redo:
+    def do_redo(self):
+        child = self.revisions[self.current].last_child
+        if child not in self.revisions:
             raise IndexError('Nothing to redo')
-        state = self.redo.pop()
-        self.undo.append(copy.deepcopy(graph))
-        return state
+        return self.goto(child)
+
+# the document edits its graph in place, so it gets a copy of the state
+    def goto(self, revision):
+        state = self.get_state(revision)
+        self.current = revision
+        return state.snapshot()
 
     def add(self, state):
-        self.undo.append(state)
-# flush redo stack, if action called from command line
-        del self.redo[:]
+        revision = self.next_revision
+        self.next_revision += 1
+        if self.current is not None:
+            self.revisions[self.current].last_child = revision
+        size = 0
+        if self.max_bytes is not None:
+            size = self.get_entry_size(state)
+        self.revisions[revision] = Revision(self.current, state, size)
+        self.current = revision
+        self.load(revision)
+        if self.spill is not None:
+            self.trim_spill()
 
+    def get_revision(self, text):
+        try:
+            revision = int(text)
+        except ValueError:
+            raise ValueError('Revision must be a number, not %s' % text)
+        if revision not in self.revisions:
+            raise IndexError('No revision %d' % revision)
+        return revision
 
-class Document(object):
+    def get_state(self, revision):
+        entry = self.revisions[revision]
+        state = entry.state
+        if state is None:
+            state = entry.state = self.spill.read_state(entry.offset)
+            self.load(revision)
+        return state
+
+    def load(self, revision):
+        self.loaded.append(revision)
+        self.size += self.revisions[revision].size
+        self.trim()
+
+# keep memory within budget: the oldest states go to the spill file, or
+# their revisions are dropped if spilling is off; the oldest revision is
+# always a root of the tree, so dropping it leaves the rest connected
+    def trim(self):
+        while self.loaded and self.over_budget():
+            revision = self.loaded[0]
+            if self.spill is None and revision == self.current:
+                break
+            self.loaded.popleft()
+            entry = self.revisions[revision]
+            self.size -= entry.size
+            if self.spill is None:
+                del self.revisions[revision]
+                continue
+            if entry.offset is None:
+                entry.offset = self.spill.write_state(entry.state)
+            entry.state = None
+
+# keep the spill file within max_spill_bytes: the oldest half of the
+# revisions is dropped and the file compacted, until it is down to half the
+# budget, so that compacting is rare; only add() calls it, so the revisions
+# a command is working with stay
+    def trim_spill(self):
+        if self.max_spill_bytes is None or (
+                self.spill.end <= self.max_spill_bytes):
+            return
+        while self.spill.end > self.max_spill_bytes / 2:
+            dropped = 0
+            oldest = sorted(self.revisions)[:len(self.revisions) / 2]
+            for revision in oldest:
+                if revision == self.current:
+                    break
+                self.drop(revision)
+                dropped += 1
+            if not dropped:
+                break
+            self.compact()
+
+    def drop(self, revision):
+        entry = self.revisions.pop(revision)
+        if entry.state is not None:
+            self.loaded.remove(revision)
+            self.size -= entry.size
+
+    def compact(self):
+        spilled = [entry for entry in self.revisions.itervalues()
+                   if entry.offset is not None]
+        moved = self.spill.compact([entry.offset for entry in spilled])
+        for entry in spilled:
+            entry.offset = moved[entry.offset]
+
+    def over_budget(self):
+        if self.max_entries is not None and \
+                len(self.loaded) > self.max_entries:
+            return True
+        if self.max_bytes is not None and self.size > self.max_bytes:
+            return True
+        return False
+
+# a state only owns the trie paths that the following edit copied away
+    def get_entry_size(self, graph):
+        count = len(graph.vertex_list) + len(graph.edge_list) + 1
+        depth = int(math.log(count, 1 << HAMT_BITS)) + 1
+        return sum((
+            sys.getsizeof(graph),
+            sys.getsizeof(graph.__dict__),
+            3 * depth * TRIE_NODE_SIZE
+        ))
+
+    def get_stats(self):
+        return {
+            'revisions': len(self.revisions),
+            'loaded_revisions': len(self.loaded),
+            'bytes': self.size,
+            'spilled_bytes': self.spill.end if self.spill is not None else 0,
+        }
+
+
+# latency histogram: bucket i counts calls that took less than 2**i
+# microseconds, the last one also everything slower
+STATS_BUCKETS = 32
+
+
+class Timer(object):
+    __slots__ = ('count', 'seconds', 'objects', 'buckets')
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.objects = 0
+        self.buckets = [0] * STATS_BUCKETS
+
+    def add(self, seconds, objects):
+        self.count += 1
+        self.seconds += seconds
+        self.objects += objects
+        bucket = int(seconds * 1000000).bit_length()
+        self.buckets[min(bucket, STATS_BUCKETS - 1)] += 1
+
+# upper bound, in microseconds, of the bucket the given share of calls fits in
+    def get_percentile(self, share):
+        seen = 0
+        for (i, count) in enumerate(self.buckets):
+            seen += count
+            if seen >= share * self.count:
+                return 2 ** i
+        return 2 ** (STATS_BUCKETS - 1)
+
+    def to_dict(self):
+        return {
+            'count': self.count,
+            'seconds': self.seconds,
+            'objects': self.objects,
+            'histogram': dict((str(2 ** i), count)
+                              for (i, count) in enumerate(self.buckets)
+                              if count),
+        }
+
+
+# opt-in timing of chosen functions: nothing is wrapped, so nothing costs,
+# until they are handed to wrap() or instrument(); times are inclusive of
+# the instrumented calls made inside
+class Stats(object):
     def __init__(self):
+        self.timers = {}
+
+    def wrap(self, name, function):
+        timer = self.timers.setdefault(name, Timer())
+
+# the GC counts container objects created minus those freed, and resets
+# the count on every collection, so collections wait until the call is over;
+# the result is net growth, which is negative for calls that free objects
+        def timed(*args, **kwargs):
+            enabled = gc.isenabled()
+            gc.disable()
+            objects = gc.get_count()[0]
+            started = time.time()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                timer.add(time.time() - started,
+                          gc.get_count()[0] - objects)
+                if enabled:
+                    gc.enable()
+        timed.__name__ = function.__name__
+        return timed
+
+# wraps the methods of one object, so that other documents are left alone
+    def instrument(self, obj, prefix, names):
+        for name in names:
+            setattr(obj, name, self.wrap(prefix + name, getattr(obj, name)))
+
+    def to_dict(self, history):
+        return {
+            'timers': dict((name, timer.to_dict())
+                           for (name, timer) in self.timers.iteritems()
+                           if timer.count),
+            'history': history.get_stats(),
+        }
+
+    def write_report(self, stream, history):
+        stream.write('%-32s %8s %10s %9s %8s %8s %9s\n' % (
+            'name', 'calls', 'total ms', 'mean us', 'p50 us', 'p99 us',
+            'objects'))
+        timers = sorted(self.timers.iteritems(),
+                        key=lambda item: -item[1].seconds)
+        for (name, timer) in timers:
+            if not timer.count:
+                continue
+            stream.write('%-32s %8d %10.1f %9.1f %8d %8d %9d\n' % (
+                name, timer.count, timer.seconds * 1000,
+                timer.seconds * 1000000 / timer.count,
+                timer.get_percentile(0.5), timer.get_percentile(0.99),
+                timer.objects))
+        items = sorted(history.get_stats().iteritems())
+        stream.write('history: %s\n' % ', '.join(
+            '%s %s' % (key, value) for (key, value) in items))
+
+
+class Document(object):
+    def __init__(self, **history_options):
         self.graph = Graph('mygraph')
-        self.history = History()
+        self.history = History(**history_options)
+# revision 0 is the empty graph
+        self.history.add(self.graph.snapshot())
+# Stats, if switched on
+        self.stats = None
 
     def exit(self, *args):
         print 'Nooooooooo\n'
@@ -208,71 +912,241 @@ class Document(object):
         self.graph.remove_edge_attribute(obj.name1, obj.name2, obj.key)
 
     def undo(self, *args):
-        self.graph = self.history.do_undo(self.graph)
+        self.graph = self.history.do_undo()
 
     def redo(self, *args):
-        self.graph = self.history.do_redo(self.graph)
+        self.graph = self.history.do_redo()
+
+    def goto(self, obj):
+        self.graph = self.history.goto(
+            self.history.get_revision(obj.revision))
+
+    def print_revisions(self, *args):
+        history = self.history
+        for revision in sorted(history.revisions):
+            parent = history.revisions[revision].parent
+            sys.stdout.write('%s %d (parent %s)\n' % (
+                '*' if revision == history.current else ' ', revision,
+                '-' if parent not in history.revisions else parent))
+
+    def diff(self, obj):
+        history = self.history
+        old = history.get_state(history.get_revision(obj.revision1))
+        new = history.get_state(history.get_revision(obj.revision2))
+        sys.stdout.write(old.get_diff(new))
+
+    def show_stats(self, obj):
+        if self.stats is None:
+            raise AttributeError('Statistics are off, start with --stats')
+        if obj.json:
+            with open(obj.json, 'w') as stream:
+                json.dump(self.stats.to_dict(self.history), stream,
+                          indent=1, sort_keys=True)
+        else:
+            self.stats.write_report(sys.stdout, self.history)
+
+
+# subcommands as (name, help, arguments, Document method, undoable); every
+# argument is a name (a flag for options) with add_argument keyword arguments
+COMMANDS = (
+    ('add_vertex', 'vertex adding', [('name', {})], 'add_vertex', True),
+    ('remove_vertex', 'vertex deleting', [('name', {})], 'remove_vertex',
+     True),
+    ('set_vertex_attribute', 'setting vertex attribute',
+     [('name', {}), ('key', {}), ('value', {})], 'set_vertex_attribute',
+     True),
+    ('add_edge', 'edge adding', [('name1', {}), ('name2', {})], 'add_edge',
+     True),
+    ('remove_edge', 'edge deleting', [('name1', {}), ('name2', {})],
+     'remove_edge', True),
+    ('set_edge_attribute', 'setting edge attribute',
+     [('name1', {}), ('name2', {}), ('key', {}), ('value', {})],
+     'set_edge_attribute', True),
+    ('undo', 'go to the parent revision', [], 'undo', False),
+    ('redo', 'go to the latest child revision', [], 'redo', False),
+    ('goto', 'go to a revision', [('revision', {})], 'goto', False),
+    ('revisions', 'revision tree printing', [], 'print_revisions', False),
+    ('diff', 'changes between two revisions',
+     [('revision1', {}), ('revision2', {})], 'diff', False),
+    ('print', 'graph printing', [], 'print_graph', False),
+    ('stats', 'command and history statistics (--stats)', [
+        ('--json', {'metavar': 'FILE', 'help': 'write them to FILE as JSON'}),
+    ], 'show_stats', False),
+    ('exit', 'exits the editor', [], 'exit', False),
+)
 
 
 def get_parser(doc):
     parser = argparse.ArgumentParser()
     subparsers = parser.add_subparsers(title="Commands", metavar="<command>")
+    for (name, help_text, arguments, method, has_undo) in COMMANDS:
+        subparser = subparsers.add_parser(name, help=help_text)
+        for (argument, options) in arguments:
+            subparser.add_argument(argument, **options)
+        subparser.set_defaults(func=getattr(doc, method), has_undo=has_undo)
+    return parser
+
+
+# command name -> (positional fields with their choices, defaults), made
+# straight from COMMANDS; the argparse parser, only needed for lines with
+# options or asking for help, is built on first use
+class CommandTable(dict):
+    def __init__(self, get_parser):
+        dict.__init__(self)
+        self.get_parser = get_parser
+        self.parser = None
+
+    def parse_args(self, words):
+        if self.parser is None:
+            self.parser = self.get_parser()
+        return self.parser.parse_args(words)
 
-    p_va = subparsers.add_parser('add_vertex', help='vertex adding')
-    p_va.add_argument('name')
-    p_va.set_defaults(func=doc.add_vertex, has_undo=True)
-
-    p_rv = subparsers.add_parser('remove_vertex', help='vertex deleting')
-    p_rv.add_argument('name')
-    p_rv.set_defaults(func=doc.remove_vertex, has_undo=True)
-
-    p_sva = subparsers.add_parser(
-        'set_vertex_attribute', help='setting vertex attribute')
-    p_sva.add_argument('name')
-    p_sva.add_argument('key')
-    p_sva.add_argument('value')
-    p_sva.set_defaults(func=doc.set_vertex_attribute, has_undo=True)
-
-    p_ae = subparsers.add_parser('add_edge', help='edge adding')
-    p_ae.add_argument('name1')
-    p_ae.add_argument('name2')
-    p_ae.set_defaults(func=doc.add_edge, has_undo=True)
-
-    p_re = subparsers.add_parser('remove_edge', help='edge deleting')
-    p_re.add_argument('name1')
-    p_re.add_argument('name2')
-    p_re.set_defaults(func=doc.remove_edge, has_undo=True)
-
-    p_sea = subparsers.add_parser(
-        'set_edge_attribute', help='setting edge attribute')
-    p_sea.add_argument('name1')
-    p_sea.add_argument('name2')
-    p_sea.add_argument('key')
-    p_sea.add_argument('value')
-    p_sea.set_defaults(func=doc.set_edge_attribute, has_undo=True)
-
-    p_undo = subparsers.add_parser('undo', help='undo the last action')
-    p_undo.set_defaults(func=doc.undo, has_undo=False)
-
-    p_redo = subparsers.add_parser('redo', help='redo the last action')
-    p_redo.set_defaults(func=doc.redo, has_undo=False)
-
-    p_pg = subparsers.add_parser('print', help='graph printing')
-    p_pg.set_defaults(func=doc.print_graph, has_undo=False)
-
-    p_exit = subparsers.add_parser('exit', help='exits the editor')
-    p_exit.set_defaults(func=doc.exit, has_undo=False)
+
+def get_table_entry(arguments, defaults):
+    fields = []
+    for (argument, options) in arguments:
+        if argument.startswith('-'):
+            default = options.get('default')
+            if default is None and options.get('action') == 'store_true':
+                default = False
+            defaults[argument.lstrip('-').replace('-', '_')] = default
+        else:
+            fields.append((argument, options.get('choices')))
+    return (fields, defaults)
+
+
+def get_command_table(doc):
+    table = CommandTable(lambda: get_parser(doc))
+    for (name, help_text, arguments, method, has_undo) in COMMANDS:
+        table[name] = get_table_entry(
+            arguments, {'func': getattr(doc, method), 'has_undo': has_undo})
+    return table
+
+
+def parse_command(table, words):
+    entry = table.get(words[0])
+    if entry is None and not words[0].startswith('-'):
+        raise ValueError('Unknown command %s' % words[0])
+    if entry is not None and not any(
+            word.startswith('-') for word in words[1:]):
+        (fields, defaults) = entry
+        if len(words) - 1 != len(fields):
+            raise ValueError(
+                '%s takes %d arguments' % (words[0], len(fields)))
+        args = argparse.Namespace(**defaults)
+        for ((field, choices), word) in zip(fields, words[1:]):
+            if choices is not None and word not in choices:
+                raise ValueError(
+                    '%s must be one of %s' % (field, ', '.join(choices)))
+            setattr(args, field, word)
+        return args
+# options and help go through argparse
+    try:
+        return table.parse_args(words)
+    except SystemExit, e:
+        if e.code:
+            raise ValueError('Bad arguments for %s' % words[0])
+# argparse has printed the help
+    return argparse.Namespace(func=lambda args: None, has_undo=False)
+
+
+def run_command(doc, args):
+    args.func(args)
+    if args.has_undo:
+        doc.history.add(doc.graph.snapshot())
+
+
+HISTORY_STATS_METHODS = ('add', 'goto', 'get_state', 'trim', 'trim_spill')
+
+
+# times every command and History operation of one document; the graph is
+# replaced by a copy of a state on undo, redo and goto (and copies take the
+# instance's attributes along), so Graph methods are left alone: each edit
+# command makes one Graph call anyway; commands are timed through the
+# Document methods, so this goes before get_command_table
+def enable_stats(doc):
+    if doc.stats is not None:
+        return
+    stats = Stats()
+    for (name, help_text, arguments, method, has_undo) in COMMANDS:
+        setattr(doc, method,
+                stats.wrap('command.' + name, getattr(doc, method)))
+    stats.instrument(doc.history, 'history.', HISTORY_STATS_METHODS)
+    doc.stats = stats
+
+
+def run_script(doc, stream, table):
+    count = 0
+    errors = 0
+# bulk runs allocate lots of long-living objects and no garbage cycles
+    gc.disable()
+    started = time.time()
+    try:
+        for (line_no, line) in enumerate(stream, 1):
+            words = line.split()
+            if not words or words[0].startswith('#'):
+                continue
+            count += 1
+            try:
+                run_command(doc, parse_command(table, words))
+            except Exception, e:
+                errors += 1
+                sys.stderr.write('line %d: %s\n' % (line_no, e))
+    finally:
+        gc.enable()
+    elapsed = time.time() - started
+    sys.stderr.write('%d commands in %.3f s (%d/s), %d errors\n' % (
+        count, elapsed, count / elapsed if elapsed else 0, errors))
+    return errors
+
+
+def get_cli_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--history-entries', type=int, metavar='N',
+        help='revisions kept in memory')
+    parser.add_argument(
+        '--history-bytes', type=int, metavar='N',
+        help='memory budget for revisions')
+    parser.add_argument(
+        '--history-spill', metavar='FILE',
+        help='spill old revisions to FILE instead of dropping them')
+    parser.add_argument(
+        '--history-spill-bytes', type=int, metavar='N',
+        help='disk budget for spilled revisions; the oldest are dropped')
+    parser.add_argument(
+        '--stats', action='store_true',
+        help="time commands and history operations (see 'stats')")
+    parser.add_argument(
+        '--script', metavar='FILE',
+        help="run commands from FILE ('-' for stdin) without the prompt")
     return parser
 
+
+def get_history_options(options):
+    return {
+        'max_entries': options.history_entries,
+        'max_bytes': options.history_bytes,
+        'spill_file': options.history_spill,
+        'max_spill_bytes': options.history_spill_bytes,
+    }
+
 if __name__ == '__main__':
-    mydoc = Document()
-    parser = get_parser(mydoc)
+    options = get_cli_parser().parse_args()
+    mydoc = Document(**get_history_options(options))
+    if options.stats:
+        enable_stats(mydoc)
+    table = get_command_table(mydoc)
+    if options.script or not sys.stdin.isatty():
+        stream = sys.stdin
+        if options.script not in (None, '-'):
+            stream = open(options.script)
+        errors = run_script(mydoc, stream, table)
+        sys.exit(1 if errors else 0)
     while True:
         try:
-            args = parser.parse_args(raw_input('\n>>> Enter action: ').split())
-            state = copy.deepcopy(mydoc.graph)
-            args.func(args)
-            if args.has_undo:
-                mydoc.history.add(state)
+            words = raw_input('\n>>> Enter action: ').split()
+            if words:
+                run_command(mydoc, parse_command(table, words))
         except Exception, e:
             print e
@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+import sys
+import argparse
+import os
+import socket
+import SocketServer
+import threading
+
+from graph_editor import (
+    Document, get_command_table, parse_command, run_command, validate_name,
+    enable_stats, add_history_arguments, get_history_options
+)
+
+# document a new session starts in
+DEFAULT_DOCUMENT = 'mygraph'
+# bytes of output collected before a send; print streams its DOT text in
+# chunks of about this size anyway
+OUTPUT_BUFFER_SIZE = 64 * 1024
+# seconds a command may wait for a client to take its output; a client that
+# stops reading loses its session instead of holding the document's lock
+SEND_TIMEOUT = 10.0
+# commands that read or write files, with the argument naming the file; they
+# only work inside the server's data directory
+FILE_ARGUMENTS = {
+    'import': 'file',
+    'save': 'file',
+    'open': 'file',
+    'stats': 'json',
+}
+
+
+# a hosted document with its own command table (and statistics, if they
+# are on); the lock lets one command at a time run on it, commands on other
+# documents go on in parallel
+class HostedDocument(object):
+    def __init__(self, name, data_dir=None, stats=False, **history_options):
+        self.document = Document(name, **history_options)
+        if stats:
+            enable_stats(self.document)
+        self.table = get_command_table(self.document)
+        self.data_dir = data_dir
+        self.lock = threading.Lock()
+
+# parsing happens under the lock too: argparse help and errors go to the
+# document's output
+    def run(self, words, output):
+        with self.lock:
+            self.document.output = output
+            args = parse_command(self.table, words)
+            if words[0] in FILE_ARGUMENTS:
+                self.confine(words[0], args)
+            run_command(self.document, args)
+
+    def confine(self, command, args):
+        field = FILE_ARGUMENTS[command]
+        path = getattr(args, field, None)
+        if path is None:
+            return
+        if self.data_dir is None:
+            raise ValueError('%s needs the server to run with --data-dir'
+                             % command)
+        root = os.path.realpath(self.data_dir)
+        path = os.path.realpath(os.path.join(root, path))
+        if not path.startswith(root + os.sep):
+            raise ValueError('%s is outside the data directory' % path)
+        setattr(args, field, path)
+
+
+# named documents, created by the first session that uses them
+class DocumentRegistry(object):
+    def __init__(self, data_dir=None, stats=False, **history_options):
+        self.data_dir = data_dir
+        self.stats = stats
+        self.history_options = history_options
+        self.documents = {}
+        self.lock = threading.Lock()
+
+    def get(self, name):
+        with self.lock:
+            hosted = self.documents.get(name)
+            if hosted is None:
+                validate_name(name)
+                options = dict(self.history_options)
+# each document spills its history into a file of its own
+                if options.get('spill_file'):
+                    options['spill_file'] = '%s.%s' % (
+                        options['spill_file'], name)
+                hosted = self.documents[name] = HostedDocument(
+                    name, self.data_dir, self.stats, **options)
+            return hosted
+
+    def get_names(self):
+        with self.lock:
+            return sorted(self.documents)
+
+
+# line protocol: one editor command per line, answered by its output and a
+# final 'ok' or 'error: ...' line; 'use NAME' switches the session to another
+# document, 'documents' lists them and 'quit' (or 'exit') ends the session
+class SessionHandler(SocketServer.StreamRequestHandler):
+    wbufsize = OUTPUT_BUFFER_SIZE
+
+    def handle(self):
+        registry = self.server.registry
+        hosted = registry.get(DEFAULT_DOCUMENT)
+        for line in iter(self.rfile.readline, ''):
+            words = line.split()
+            if not words or words[0].startswith('#'):
+                continue
+            if words[0] in ('quit', 'exit'):
+                break
+# waiting for the next line has no time limit, sending output has
+            self.connection.settimeout(SEND_TIMEOUT)
+            try:
+                hosted = self.run(registry, hosted, words)
+            except socket.error:
+                break
+            self.connection.settimeout(None)
+
+# returns the document the session goes on with
+    def run(self, registry, hosted, words):
+        try:
+            if words[0] == 'use':
+                if len(words) != 2:
+                    raise ValueError('use takes 1 argument')
+                hosted = registry.get(words[1])
+            elif words[0] == 'documents':
+                for name in registry.get_names():
+                    self.wfile.write(name + '\n')
+            else:
+                hosted.run(words, self.wfile)
+            self.wfile.write('ok\n')
+        except socket.error:
+            raise
+        except Exception, e:
+            self.wfile.write('error: %s\n' % e)
+        self.wfile.flush()
+        return hosted
+
+
+class TCPServer(SocketServer.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class UnixServer(SocketServer.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+
+def get_server(options):
+    if options.unix:
+        server = UnixServer(options.unix, SessionHandler)
+    else:
+        server = TCPServer((options.host, options.port), SessionHandler)
+    server.registry = DocumentRegistry(
+        options.data_dir, options.stats, **get_history_options(options))
+    return server
+
+
+def get_cli_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument(
+        '--unix', metavar='PATH', help='listen on a Unix socket instead')
+    parser.add_argument(
+        '--data-dir', metavar='DIR',
+        help='directory for import, save, open and stats --json; without '
+             'it these commands are refused')
+    parser.add_argument(
+        '--stats', action='store_true',
+        help="time commands and graph operations of every document (see "
+             "'stats')")
+    add_history_arguments(parser)
+    return parser
+
+if __name__ == '__main__':
+    server = get_server(get_cli_parser().parse_args())
+    sys.stderr.write('serving on %s\n' % (server.server_address,))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()